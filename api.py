@@ -1,29 +1,74 @@
 """HTTP+JSON API for script server."""
 
+import calendar
 import json
+import os
+from string import hexdigits, Template
+import time
 
-from flask import g, request, send_file, session
+from flask import g, make_response, request, session
 from flask.ext import restful
 from flask.ext.restful import abort
 
 from sessions import start_session, end_session, login_required
+import downloads
 import files
+import uploads
 import users
 
 
+def get_arg(name, type, default=None):
+    """Get a query parameter converted to 'type'.
+
+    Aborts with status 400 if the parameter can't be converted."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return type(value)
+    except ValueError:
+        abort(400, message=('Invalid parameter: %s' % name))
+
+
+def id_list(value):
+    """Convert a comma-separated list of job ids to a list of integers."""
+    return [int(i) for i in value.split(',') if i]
+
+
+def attempts(value):
+    """Convert a maximum number of attempts to a positive integer."""
+    value = int(value)
+    if value < 1:
+        raise ValueError('Invalid number of attempts: %d' % value)
+    return value
+
+
+def job_filters():
+    """Get filters for job lists from the query parameters."""
+    return {'status': request.args.get('status'),
+            'user': request.args.get('user'),
+            'since': request.args.get('since'),
+            'until': request.args.get('until')}
+
+
 class Info(restful.Resource):
     def get(self):
         username = None
         user_id = session.get('user_id')
         if user_id is not None:
             (user_id, username, admin, directory) = users.user_info(user_id)
-        running = g.job_manager.count_jobs(g.db, 'running')
-        waiting = g.job_manager.count_jobs(g.db, 'waiting')
+        count = lambda status: g.job_manager.count_jobs(g.db, status)
         return {'version': g.version,
                 'name': g.config.get('NAME'),
                 'username': username,
-                'jobs_running': running,
-                'jobs_waiting': waiting}
+                'jobs_running': count('running'),
+                'jobs_waiting': count('waiting'),
+                'jobs_blocked': count('blocked'),
+                'jobs_retrying': count('retrying'),
+                'jobs_done': count('done'),
+                'jobs_failed': count('failed'),
+                'jobs_cancelled': count('cancelled'),
+                'max_running': g.job_manager.max_running()}
 
 
 class Login(restful.Resource):
@@ -51,14 +96,116 @@ class Run(restful.Resource):
     @login_required
     def post(self):
         script = request.data
-        job_id = g.job_manager.new_job(g.db, g.user_id, script)
+        priority = get_arg('priority', int, 0)
+        depends_on = get_arg('depends_on', id_list, [])
+        max_attempts = get_arg('max_attempts', attempts)
+        try:
+            job_id = g.job_manager.new_job(g.db, g.user_id, script, priority,
+                                           depends_on, max_attempts)
+        except ValueError as e:
+            abort(400, message=str(e))
         return {'job_id': job_id}
 
 
+def batch_scripts(o):
+    """Get the list of scripts from a batch request (see 'RunBatch').
+
+    Aborts with status 400 if the request is invalid."""
+    if 'scripts' in o:
+        scripts = o['scripts']
+        if not (isinstance(scripts, list) and
+                all(isinstance(s, basestring) for s in scripts)):
+            abort(400, message='"scripts" must be a list of strings.')
+        return [s.encode('utf-8') for s in scripts]
+    template = o.get('template')
+    parameters = o.get('parameters')
+    if not (isinstance(template, basestring) and
+            isinstance(parameters, list) and
+            all(isinstance(p, dict) for p in parameters)):
+        abort(400, message='Expected "scripts", or "template" and '
+                           '"parameters".')
+    template = Template(template)
+    try:
+        return [template.substitute(p).encode('utf-8') for p in parameters]
+    except KeyError as e:
+        abort(400, message=('Missing parameter: %s' % e.args[0]))
+    except ValueError as e:
+        abort(400, message=('Invalid template: %s' % e))
+
+
+class RunBatch(restful.Resource):
+    @login_required
+    def post(self):
+        o = json.load(request.stream)
+        if not isinstance(o, dict):
+            abort(400)
+        scripts = batch_scripts(o)
+        if len(scripts) > g.config['BATCH_MAX_JOBS']:
+            abort(400, message=('Too many scripts, at most %d are allowed.'
+                                % g.config['BATCH_MAX_JOBS']))
+        priority = o.get('priority', 0)
+        if not isinstance(priority, int):
+            abort(400, message='Invalid priority.')
+        depends_on = o.get('depends_on', [])
+        if not (isinstance(depends_on, list) and
+                all(isinstance(i, int) for i in depends_on)):
+            abort(400, message='"depends_on" must be a list of job ids.')
+        max_attempts = o.get('max_attempts')
+        if max_attempts is not None and not (isinstance(max_attempts, int)
+                                             and max_attempts >= 1):
+            abort(400, message='"max_attempts" must be a positive integer.')
+        try:
+            job_ids = g.job_manager.new_jobs(g.db, g.user_id, scripts,
+                                             priority, depends_on,
+                                             max_attempts)
+        except ValueError as e:
+            abort(400, message=str(e))
+        return {'job_ids': job_ids}
+
+
 class Jobs(restful.Resource):
     @login_required
     def get(self):
-        return g.job_manager.list_jobs(g.db)
+        page_size = g.config['JOBS_PAGE_SIZE']
+        after_id = get_arg('after_id', int)
+        limit = min(get_arg('limit', int, page_size), page_size)
+        if limit < 0:
+            abort(400, message='Invalid parameter: limit')
+        filters = job_filters()
+        jobs = g.job_manager.list_jobs(g.db, after_id, limit, **filters)
+        total = g.job_manager.count_matching_jobs(g.db, **filters)
+        return jobs, 200, {'X-Total-Count': str(total)}
+
+    @login_required
+    def post(self):
+        o = json.load(request.stream)
+        if not (isinstance(o, dict) and 'command' in o):
+            abort(400)
+        cmd = o['command']
+        if cmd not in ('cancel', 'terminate', 'kill'):
+            abort(400, message=('No such command: "%s"' % cmd))
+        filters = dict((name, o.get(name)) for name in
+                       ('status', 'user', 'since', 'until', 'from_id',
+                        'to_id'))
+        job_ids = o.get('job_ids')
+        if job_ids is None and all(v is None for v in filters.values()):
+            abort(400, message='Select jobs with at least one filter.')
+        if job_ids is not None and not (
+                isinstance(job_ids, list) and
+                all(isinstance(i, int) for i in job_ids)):
+            abort(400, message='"job_ids" must be a list of job ids.')
+        if not g.admin:
+            # users may only control their own jobs
+            if filters['user'] not in (None, g.username):
+                abort(403)
+            filters['user'] = g.username
+        selected = g.job_manager.find_jobs(g.db, job_ids, **filters)
+        if cmd == 'cancel':
+            affected = g.job_manager.cancel_jobs(g.db, selected)
+        else:
+            affected = g.job_manager.terminate_jobs(g.db, selected,
+                                                    kill=(cmd == 'kill'))
+        return {'job_ids': affected}
 
 
 class Job(restful.Resource):
@@ -84,7 +231,11 @@ class Job(restful.Resource):
         if not (isinstance(o, dict) and 'command' in o):
             abort(400)
         cmd = o['command']
-        if cmd == 'terminate':
+        if cmd == 'cancel':
+            if not g.job_manager.cancel_jobs(g.db, [job_id]):
+                abort(400, message=('Job %d is not waiting.' % job_id))
+            return '', 204
+        elif cmd == 'terminate':
             try:
                 g.job_manager.terminateJob(g.db, job_id)
             except KeyError:
@@ -99,6 +250,29 @@ class Job(restful.Resource):
         abort(400, message=('No such command: "%s"' % cmd))
 
 
+class JobOutput(restful.Resource):
+
+    @login_required
+    def get(self, job_id, stream):
+        offset = get_arg('offset', int, 0)
+        size = get_arg('size', int)
+        # requests with 'wait' have already waited for output in
+        # 'longpoll.OutputPoll', outside of the request threads
+        wait = get_arg('wait', float, 0)
+        if offset < 0 or (size is not None and size < 0) or wait < 0:
+            abort(400, message='Invalid parameter.')
+        result = g.job_manager.read_output(g.db, job_id, stream,
+                                           offset, size)
+        if result is None:
+            abort(404, message=('No such job: %d' % job_id))
+        status, data = result
+        response = make_response(data)
+        response.mimetype = 'text/plain'
+        response.headers['X-Job-Status'] = status
+        response.headers['X-Output-Offset'] = str(offset + len(data))
+        return response
+
+
 def format_file_info(f):
     info = {}
     info['name'] = f['name']
@@ -108,6 +282,37 @@ def format_file_info(f):
     return info
 
 
+def compression_level(value):
+    """Convert a compression level to an integer from 0 to 9."""
+    value = int(value)
+    if not 0 <= value <= 9:
+        raise ValueError('Invalid compression level: %d' % value)
+    return value
+
+
+def timestamp(value):
+    """Convert an ISO 8601 date or time in UTC to seconds since the
+    epoch."""
+    value = value.rstrip('Z').replace(' ', 'T')
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, format))
+        except ValueError:
+            pass
+    raise ValueError('Invalid time: %s' % value)
+
+
+def send_archive(p, archive):
+    """Send the directory 'p' as an archive."""
+    if archive not in downloads.ARCHIVES:
+        abort(400, message=('Invalid archive format: %s' % archive))
+    name = os.path.basename(p.rstrip('/')) or 'files'
+    return downloads.send_archive(files.absolute(p), name, archive,
+                                  get_arg('level', compression_level, 6),
+                                  request.args.get('pattern'),
+                                  get_arg('since', timestamp))
+
+
 class File(restful.Resource):
 
     @login_required
@@ -115,9 +320,24 @@ class File(restful.Resource):
         if not files.exists(p):
             abort(404, message=('File not found: %s' % p))
         if files.is_directory(p):
-            return [format_file_info(f) for f in files.directory_listing(p)]
+            archive = request.args.get('archive')
+            if archive is not None:
+                return send_archive(p, archive)
+            sort = request.args.get('sort', 'name')
+            offset = get_arg('offset', int, 0)
+            limit = get_arg('limit', int)
+            if offset < 0 or (limit is not None and limit < 0):
+                abort(400, message='Invalid parameter: offset or limit')
+            try:
+                listing, total = files.directory_listing(
+                    p, sort.lstrip('-'), sort.startswith('-'),
+                    request.args.get('pattern'), offset, limit)
+            except ValueError as e:
+                abort(400, message=str(e))
+            return ([format_file_info(f) for f in listing], 200,
+                    {'X-Total-Count': str(total)})
         else:
-            return send_file(files.absolute(p))
+            return downloads.send_file(files.absolute(p))
 
     @login_required
     def post(self, p):
@@ -155,13 +375,7 @@ class File(restful.Resource):
 
     @login_required
     def put(self, p):
-        block_size = 64 * 1024
-        with open(files.absolute(p), 'wb') as f:
-            while 1:
-                buffer = request.stream.read(block_size)
-                if not buffer:
-                    break
-                f.write(buffer)
+        uploads.write_file(files.absolute(p), request.stream)
         return format_file_info(files.file_info(p))
 
     @login_required
@@ -174,6 +388,86 @@ class File(restful.Resource):
             abort(501, 'File system error: ' + e.strerror)
 
 
+def format_upload(u):
+    return {'upload_id': u['upload_id'], 'path': u['path'],
+            'size': u['size'], 'received': u['received']}
+
+
+class Uploads(restful.Resource):
+
+    @login_required
+    def post(self):
+        o = json.load(request.stream)
+        if not isinstance(o, dict) or 'path' not in o:
+            abort(400, message='"path" is required.')
+        p = o['path']
+        size = o.get('size')
+        if size is not None and not (isinstance(size, (int, long)) and
+                                     size >= 0):
+            abort(400, message='"size" must be a number of bytes.')
+        directory = os.path.dirname(p)
+        if not files.is_directory(directory):
+            abort(404, message=('Directory not found: %s' % directory))
+        if files.is_directory(p):
+            abort(400, message=('Is a directory: %s' % p))
+        upload_id = uploads.new_upload(g.db, g.user_id, p, files.absolute(p),
+                                       size)
+        return format_upload(uploads.get_upload(g.db, upload_id, g.user_id))
+
+
+class Upload(restful.Resource):
+
+    def get_upload(self, upload_id):
+        upload = uploads.get_upload(g.db, upload_id, g.user_id)
+        if upload is None:
+            abort(404, message=('Upload not found: %s' % upload_id))
+        return upload
+
+    @login_required
+    def get(self, upload_id):
+        return format_upload(self.get_upload(upload_id))
+
+    @login_required
+    def put(self, upload_id):
+        upload = self.get_upload(upload_id)
+        offset = get_arg('offset', int)
+        if offset is None or offset < 0:
+            abort(400, message='Invalid parameter: offset')
+        length = request.content_length
+        if length is None:
+            abort(411)
+        if upload['size'] is not None and offset + length > upload['size']:
+            abort(400, message='Chunk extends beyond the end of the file.')
+        uploads.write_chunk(g.db, upload, offset, request.stream)
+        return format_upload(self.get_upload(upload_id))
+
+    @login_required
+    def post(self, upload_id):
+        upload = self.get_upload(upload_id)
+        o = json.load(request.stream)
+        if not (isinstance(o, dict) and o.get('command') == 'commit'):
+            abort(400)
+        checksums = dict((name, o[name]) for name in uploads.CHECKSUMS
+                         if name in o)
+        for name, value in checksums.items():
+            if not (isinstance(value, basestring) and value and
+                    all(c in hexdigits for c in value)):
+                abort(400, message=('"%s" must be a hex string.' % name))
+        path = files.absolute(upload['path'])
+        try:
+            uploads.commit_upload(g.db, upload, path, checksums)
+        except uploads.UploadError as e:
+            abort(409, message=str(e))
+        except (OSError, IOError) as e:
+            abort(500, message=('File system error: ' + e.strerror))
+        return format_file_info(files.file_info(upload['path']))
+
+    @login_required
+    def delete(self, upload_id):
+        uploads.delete_upload(g.db, self.get_upload(upload_id))
+        return '', 204
+
+
 def add_api(app):
     """Add JSON API to Flask app."""
     api = restful.Api(app, '/api')
@@ -181,7 +475,11 @@ def add_api(app):
     api.add_resource(Login,  '/login')
     api.add_resource(Logout, '/logout')
     api.add_resource(Run,    '/run')
+    api.add_resource(RunBatch, '/run/batch')
     api.add_resource(Jobs,   '/jobs')
     api.add_resource(Job,    '/jobs/<int:job_id>')
+    api.add_resource(JobOutput, '/jobs/<int:job_id>/<any(out, err):stream>')
     api.add_resource(File,   '/files/', endpoint='fr', defaults={'p': ''})
     api.add_resource(File,   '/files/<path:p>')
+    api.add_resource(Uploads, '/uploads')
+    api.add_resource(Upload, '/uploads/<upload_id>')
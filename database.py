@@ -1,8 +1,330 @@
+"""Helper functions for database access.
+
+The database schema is versioned using SQLite's 'user_version' pragma. New
+databases are created from 'schema.sql', which always contains the current
+schema. Existing databases are upgraded by running the migrations below;
+when changing the schema, update 'schema.sql' and add a migration.
+"""
+
+from contextlib import contextmanager
+import Queue
 import sqlite3
+import threading
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import failure, log
+
+import scripts
+
 
-"""Helper function for database access."""
+def _store_scripts(db):
+    """Move scripts from the job table to the script table."""
+    db.execute("""CREATE TABLE script (
+                      digest text primary key,
+                      content blob not null)""")
+    db.execute("ALTER TABLE job ADD COLUMN script_digest text")
+    c = db.cursor()
+    last_id = -1
+    while True:
+        c.execute("""SELECT job_id, script FROM job
+                     WHERE job_id > ? ORDER BY job_id LIMIT 1000""",
+                  (last_id,))
+        rows = c.fetchall()
+        if not rows:
+            break
+        for job_id, content in rows:
+            d = scripts.store(c, str(content))
+            c.execute("UPDATE job SET script_digest=? WHERE job_id=?",
+                      (d, job_id))
+        last_id = rows[-1][0]
+    db.execute("""CREATE TABLE job_new (
+                      job_id integer primary key,
+                      user_id not null references user(user_id),
+                      status text not null default 'waiting',
+                      priority integer not null default 0,
+                      script_digest text not null
+                          references script(digest),
+                      submit_time timestamp,
+                      start_time timestamp,
+                      end_time timestamp,
+                      out text,
+                      err text,
+                      out_file text,
+                      err_file text,
+                      out_bytes integer,
+                      err_bytes integer)""")
+    db.execute("""INSERT INTO job_new
+                  SELECT job_id, user_id, status, priority, script_digest,
+                         submit_time, start_time, end_time, out, err,
+                         out_file, err_file, out_bytes, err_bytes
+                  FROM job""")
+    db.execute("DROP TABLE job")
+    db.execute("ALTER TABLE job_new RENAME TO job")
+    db.execute("CREATE INDEX job_status ON job (status, job_id)")
+    db.execute("CREATE INDEX job_user ON job (user_id, job_id)")
+    db.execute("CREATE INDEX job_script ON job (script_digest)")
+
+
+# MIGRATIONS[i] upgrades a database from version i to version i+1. It's
+# either an SQL script or a function that's called with the connection.
+MIGRATIONS = [
+    # 1: spool files for job output
+    """ALTER TABLE job ADD COLUMN out_file text;
+       ALTER TABLE job ADD COLUMN err_file text;
+       ALTER TABLE job ADD COLUMN out_bytes integer;
+       ALTER TABLE job ADD COLUMN err_bytes integer;""",
+    # 2: indexes for queries on job status and owner
+    """CREATE INDEX job_status ON job (status, job_id);
+       CREATE INDEX job_user ON job (user_id, job_id);""",
+    # 3: submission time of jobs
+    """ALTER TABLE job ADD COLUMN submit_time timestamp;""",
+    # 4: job priorities
+    """ALTER TABLE job ADD COLUMN priority integer not null default 0;""",
+    # 5: content-addressed script storage
+    _store_scripts,
+    # 6: compressed job output
+    """ALTER TABLE job ADD COLUMN compression text;""",
+    # 7: resource usage
+    """ALTER TABLE job ADD COLUMN max_rss integer;
+       ALTER TABLE job ADD COLUMN user_time real;
+       ALTER TABLE job ADD COLUMN sys_time real;""",
+    # 8: job dependencies
+    """CREATE TABLE job_dependency (
+           job_id integer not null references job(job_id),
+           parent_id integer not null references job(job_id),
+           primary key (job_id, parent_id));
+       CREATE INDEX job_dependency_parent ON job_dependency (parent_id);""",
+    # 9: process ids of detached jobs
+    """ALTER TABLE job ADD COLUMN pid integer;""",
+    # 10: retries of failed jobs
+    """ALTER TABLE job ADD COLUMN max_attempts integer;
+       ALTER TABLE job ADD COLUMN retry_time timestamp;
+       CREATE TABLE job_attempt (
+           job_id integer not null references job(job_id),
+           attempt integer not null,
+           start_time timestamp,
+           end_time timestamp,
+           returncode integer,
+           max_rss integer,
+           user_time real,
+           sys_time real,
+           primary key (job_id, attempt));""",
+    # 11: resumable uploads
+    """CREATE TABLE upload (
+           upload_id text primary key,
+           user_id integer not null references user(user_id),
+           path text not null,
+           temp_path text not null,
+           size integer,
+           update_time timestamp);
+       CREATE TABLE upload_chunk (
+           upload_id text not null references upload(upload_id),
+           start integer not null,
+           stop integer not null,
+           primary key (upload_id, start));""",
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
 
 
 def connect(dbname):
     """Connect to the script server database."""
     return sqlite3.connect(dbname, detect_types=sqlite3.PARSE_COLNAMES)
+
+
+def configure(db, wal=True, synchronous='NORMAL', busy_timeout=5000,
+              cache_size=-16000):
+    """Set pragmas for a database connection.
+
+    With 'wal', the database uses write-ahead logging, so readers don't block
+    behind writers. 'synchronous' is one of 'OFF', 'NORMAL' or 'FULL';
+    'NORMAL' is safe in WAL mode. 'busy_timeout' is in milliseconds and
+    'cache_size' in pages, or in KiB if it's negative."""
+    if synchronous not in ('OFF', 'NORMAL', 'FULL'):
+        raise ValueError('Invalid synchronous setting: %s' % synchronous)
+    if wal:
+        db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = %s' % synchronous)
+    db.execute('PRAGMA busy_timeout = %d' % busy_timeout)
+    db.execute('PRAGMA cache_size = %d' % cache_size)
+
+
+class ConnectionPool:
+
+    """Provides database connections to request handlers and callbacks.
+
+    Each thread gets its own connection, which is opened on first use and
+    then reused, since SQLite connections can't be shared between threads.
+    If 'reuse' is False, a new connection is opened for every call to
+    'connection' and closed again by 'release'. The other keyword arguments
+    are passed to 'configure'."""
+
+    def __init__(self, dbname, reuse=True, **pragmas):
+        self.dbname = dbname
+        self.reuse = reuse
+        self.pragmas = pragmas
+        self.local = threading.local()
+
+    def connection(self):
+        """Get a connection for the current thread."""
+        db = getattr(self.local, 'db', None) if self.reuse else None
+        if db is None:
+            db = connect(self.dbname)
+            configure(db, **self.pragmas)
+            if self.reuse:
+                self.local.db = db
+        return db
+
+    def release(self, db):
+        """Give back a connection after use.
+
+        Any uncommitted changes are rolled back, so the next user of the
+        connection starts with a clean slate."""
+        if self.reuse:
+            db.rollback()
+        else:
+            db.close()
+
+    @contextmanager
+    def borrow(self):
+        """Context manager providing a connection that's released when the
+        block ends."""
+        db = self.connection()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+
+class Writer:
+
+    """Runs database updates on a dedicated thread, so the threads that
+    request them don't wait for the database.
+
+    The functions passed to 'run' are called one at a time, in the order
+    they were passed, with the writer's connection, which it takes from
+    'pool'. Functions that are queued while a transaction is being committed
+    are run together in the next transaction, up to 'max_batch' of them, so
+    updates that arrive close together share a single commit. Each function
+    runs in a savepoint; if it raises an exception, only its own changes are
+    rolled back. The functions must not commit.
+
+    If the database is locked by another connection, the writer waits for
+    it, trying again at most every 'max_delay' seconds."""
+
+    def __init__(self, pool, max_batch=1000, max_delay=5):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = Queue.Queue()
+        thread = threading.Thread(target=self._loop, name='database writer')
+        thread.daemon = True
+        thread.start()
+
+    def run(self, f, *args, **kwargs):
+        """Call f(db, *args, **kwargs) on the writer thread. Can be called
+        from any thread.
+
+        Returns a Deferred that fires on the reactor thread with the result
+        once it's committed. Deferreds fire in the order the functions were
+        passed."""
+        d = defer.Deferred()
+        self.queue.put((f, args, kwargs, d))
+        return d
+
+    def _loop(self):
+        db = self.pool.connection()
+        # transactions are managed explicitly, see '_write'
+        db.isolation_level = None
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            for d, result in self._write(db, batch):
+                if isinstance(result, failure.Failure):
+                    reactor.callFromThread(d.errback, result)
+                else:
+                    reactor.callFromThread(d.callback, result)
+
+    def _execute(self, db, sql):
+        """Execute a statement that needs the database's write lock. If
+        another connection holds it for longer than the busy timeout, keep
+        trying instead of failing the whole batch."""
+        delay = 0.1
+        while True:
+            try:
+                return db.execute(sql)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                log.msg('Database is locked, trying again: %s' % sql)
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    def _write(self, db, batch):
+        """Run a batch of functions in a single transaction and return a
+        list of (Deferred, result or Failure) pairs."""
+        results = []
+        try:
+            self._execute(db, 'BEGIN IMMEDIATE')
+            for f, args, kwargs, d in batch:
+                db.execute('SAVEPOINT batch_item')
+                try:
+                    result = f(db, *args, **kwargs)
+                except Exception:
+                    result = failure.Failure()
+                    db.execute('ROLLBACK TO batch_item')
+                db.execute('RELEASE batch_item')
+                results.append((d, result))
+            # a failed commit leaves the transaction open, so it can be
+            # tried again
+            self._execute(db, 'COMMIT')
+        except Exception:
+            error = failure.Failure()
+            try:
+                db.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            return [(d, error) for f, args, kwargs, d in batch]
+        return results
+
+
+def schema_version(db):
+    """Get the schema version of the database."""
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(db):
+    """Upgrade the database to the current schema version.
+
+    Each migration runs in its own transaction, together with the update of
+    the version number."""
+    version = schema_version(db)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError('Database schema version %d is newer than this '
+                           'version of the script server (%d).'
+                           % (version, SCHEMA_VERSION))
+    for v in range(version, SCHEMA_VERSION):
+        migration = MIGRATIONS[v]
+        if not callable(migration):
+            db.executescript('BEGIN;\n%s\nPRAGMA user_version = %d;\nCOMMIT;'
+                             % (migration, v + 1))
+            continue
+        # manage the transaction explicitly, since the sqlite3 module would
+        # otherwise commit before each schema change
+        isolation_level = db.isolation_level
+        db.isolation_level = None
+        try:
+            db.execute('BEGIN')
+            migration(db)
+            db.execute('PRAGMA user_version = %d' % (v + 1))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.isolation_level = isolation_level
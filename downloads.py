@@ -0,0 +1,368 @@
+"""Serve files for download.
+
+Responses carry an ETag and a Last-Modified header, so clients can check
+whether a file has changed with If-None-Match or If-Modified-Since and get
+a 304 response if it hasn't. Range requests, including requests for several
+ranges (which are sent as multipart/byteranges), let clients resume
+downloads or read parts of large files; with If-Range, the range is only
+sent if the file hasn't changed, and the whole file otherwise.
+
+Whole files are passed to the WSGI server's file wrapper, if it has one, so
+servers that support it can send them with sendfile.
+
+Directories can be downloaded as tar or zip archives, which are generated
+while they're sent, a block at a time, so they're never stored on disk or
+in memory.
+"""
+
+from datetime import datetime
+from fnmatch import translate
+import mimetypes
+import os
+import re
+import stat
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+
+from flask import request, Response
+from werkzeug.http import http_date, parse_date, parse_etags
+from werkzeug.http import parse_range_header, quote_etag, unquote_etag
+from werkzeug.wsgi import wrap_file
+
+
+# bytes read at a time; large blocks mean fewer round trips between the
+# WSGI thread and the server
+BLOCK_SIZE = 256 * 1024
+
+
+def send_file(path):
+    """Return a response for a GET or HEAD request for the file 'path'."""
+    f = open(path, 'rb')
+    try:
+        s = os.fstat(f.fileno())
+        length = s.st_size
+        etag = quote_etag('%x-%x-%x' % (s.st_ino, length,
+                                        int(s.st_mtime * 1000000)))
+        last_modified = datetime.utcfromtimestamp(int(s.st_mtime))
+        headers = {'ETag': etag,
+                   'Last-Modified': http_date(last_modified),
+                   'Accept-Ranges': 'bytes',
+                   # let clients cache files, but check if they've changed
+                   'Cache-Control': 'no-cache'}
+        mimetype = (mimetypes.guess_type(path)[0] or
+                    'application/octet-stream')
+        if not modified(etag, last_modified):
+            f.close()
+            return Response(status=304, headers=headers)
+        ranges = None
+        if range_applies(etag, last_modified):
+            ranges = byte_ranges(request.headers.get('Range'), length)
+        if ranges is None:
+            headers['Content-Length'] = str(length)
+            body = wrap_file(request.environ, f, BLOCK_SIZE)
+            return Response(body, 200, headers, mimetype=mimetype,
+                            direct_passthrough=True)
+        if not ranges:
+            f.close()
+            headers['Content-Range'] = 'bytes */%d' % length
+            return Response(status=416, headers=headers)
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            headers['Content-Range'] = content_range(start, stop, length)
+            headers['Content-Length'] = str(stop - start)
+            return Response(read_range(f, start, stop), 206, headers,
+                            mimetype=mimetype, direct_passthrough=True)
+        boundary = os.urandom(16).encode('hex')
+        parts = [('--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n'
+                  % (boundary, mimetype, content_range(start, stop, length)),
+                  start, stop)
+                 for start, stop in ranges]
+        end = '--%s--\r\n' % boundary
+        headers['Content-Length'] = str(
+            sum(len(head) + stop - start + 2 for head, start, stop in parts)
+            + len(end))
+        return Response(read_parts(f, parts, end), 206, headers,
+                        mimetype='multipart/byteranges; boundary=' + boundary,
+                        direct_passthrough=True)
+    except:
+        f.close()
+        raise
+
+
+def modified(etag, last_modified):
+    """Check the request's If-None-Match and If-Modified-Since headers."""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return not parse_etags(if_none_match).contains_weak(
+            unquote_etag(etag)[0])
+    since = parse_date(request.headers.get('If-Modified-Since'))
+    return since is None or last_modified > since
+
+
+def range_applies(etag, last_modified):
+    """Check the request's If-Range header, which makes the Range header
+    apply only if the file hasn't changed."""
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_date(if_range) == last_modified
+
+
+def byte_ranges(header, length):
+    """Parse a Range header for a file of 'length' bytes.
+
+    Return a sorted list of (start, stop) tuples, with overlapping ranges
+    merged, an empty list if none of the ranges can be satisfied, or None if
+    there's no valid Range header, in which case the whole file is sent.
+    """
+    parsed = parse_range_header(header)
+    if parsed is None or parsed.units != 'bytes':
+        return None
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            # the last -start bytes
+            start, stop = max(length + start, 0), length
+        elif stop is None or stop > length:
+            stop = length
+        if start < stop:
+            ranges.append((start, stop))
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def content_range(start, stop, length):
+    return 'bytes %d-%d/%d' % (start, stop - 1, length)
+
+
+def read_blocks(f, start, stop):
+    """Read the bytes from 'start' to 'stop' from 'f' in blocks."""
+    f.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = f.read(min(BLOCK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def read_range(f, start, stop):
+    """Generate the body of a single range response and close 'f' at the
+    end."""
+    try:
+        for data in read_blocks(f, start, stop):
+            yield data
+    finally:
+        f.close()
+
+
+def read_parts(f, parts, end):
+    """Generate a multipart/byteranges body from (part header, start, stop)
+    tuples and the closing boundary 'end', and close 'f' at the end."""
+    try:
+        for head, start, stop in parts:
+            yield head
+            for data in read_blocks(f, start, stop):
+                yield data
+            yield '\r\n'
+        yield end
+    finally:
+        f.close()
+
+
+# archive formats and their mimetypes
+ARCHIVES = {'tar': 'application/x-tar',
+            'tar.gz': 'application/gzip',
+            'zip': 'application/zip'}
+
+
+def send_archive(path, name, archive, level=6, pattern=None, since=None):
+    """Return a response with an archive of the files in the directory
+    'path' and its subdirectories, in the format 'archive' (see ARCHIVES),
+    with 'level' as compression level for 'tar.gz' and 'zip' (0 to store
+    the files uncompressed). Only the files whose name matches the glob
+    'pattern' and that were modified at or after 'since' (a timestamp) are
+    included. In the archive, the files are in a directory called 'name'.
+    """
+    files = archive_files(path, name, pattern, since)
+    if archive == 'zip':
+        chunks = zip_archive(files, level)
+    else:
+        chunks = tar_archive(files, level if archive == 'tar.gz' else None)
+    headers = {'Content-Disposition':
+               'attachment; filename="%s.%s"' % (name, archive)}
+    return Response(buffered(chunks), 200, headers,
+                    mimetype=ARCHIVES[archive], direct_passthrough=True)
+
+
+def archive_files(path, name, pattern=None, since=None):
+    """Find the regular files below 'path' that match 'pattern' and were
+    modified since 'since', and generate (path, name in the archive, stat
+    result) tuples for them. Hidden files and directories are left out."""
+    match = None if pattern is None else re.compile(translate(pattern)).match
+    for directory, subdirectories, filenames in os.walk(path):
+        subdirectories[:] = sorted(d for d in subdirectories
+                                   if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            if match is not None and not match(filename):
+                continue
+            file_path = os.path.join(directory, filename)
+            try:
+                s = os.stat(file_path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(s.st_mode):
+                continue
+            if since is not None and s.st_mtime < since:
+                continue
+            yield (file_path,
+                   os.path.join(name, os.path.relpath(file_path, path)), s)
+
+
+def archive_blocks(f, size):
+    """Read exactly 'size' bytes from 'f', so the archive matches the size
+    that was recorded for the file, padding with zeros if the file was
+    truncated in the meantime."""
+    for data in read_blocks(f, 0, size):
+        size -= len(data)
+        yield data
+    if size > 0:
+        yield '\0' * size
+
+
+def tar_archive(files, level=None):
+    """Generate a tar archive of (path, name, stat result) tuples,
+    compressed with gzip if 'level' isn't None."""
+    if level is not None:
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        compress = compressor.compress
+    else:
+        compress = lambda data: data
+    for path, name, s in files:
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            continue
+        with f:
+            info = tarfile.TarInfo(name)
+            info.size = s.st_size
+            info.mtime = int(s.st_mtime)
+            info.mode = stat.S_IMODE(s.st_mode)
+            yield compress(info.tobuf(tarfile.GNU_FORMAT))
+            for data in archive_blocks(f, s.st_size):
+                yield compress(data)
+            yield compress('\0' * (-s.st_size % tarfile.BLOCKSIZE))
+    # end of archive
+    yield compress('\0' * (2 * tarfile.BLOCKSIZE))
+    if level is not None:
+        yield compressor.flush()
+
+
+class ArchiveOutput:
+
+    """File-like object that collects what's written to it and keeps track
+    of its position, for 'zipfile.ZipFile'."""
+
+    def __init__(self):
+        self.data = []
+        self.position = 0
+
+    def write(self, data):
+        self.data.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """Return what was written since the last call, and forget it."""
+        data = ''.join(self.data)
+        self.data = []
+        return data
+
+
+def zip_archive(files, level=6):
+    """Generate a zip archive of (path, name, stat result) tuples, with the
+    files compressed at 'level', or stored if it's 0.
+
+    Each file's CRC and compressed size are only known after it's been
+    written, so they follow it in a data descriptor; the central directory
+    at the end is written by 'zipfile'.
+    """
+    output = ArchiveOutput()
+    archive = zipfile.ZipFile(output, 'w', allowZip64=True)
+    for path, name, s in files:
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            continue
+        with f:
+            # zip files can't store dates before 1980
+            date_time = max(time.localtime(s.st_mtime)[:6],
+                            (1980, 1, 1, 0, 0, 0))
+            info = zipfile.ZipInfo(name, date_time)
+            info.external_attr = (s.st_mode & 0xffff) << 16
+            info.flag_bits |= 0x08
+            info.header_offset = output.tell()
+            compressor = None
+            if level:
+                info.compress_type = zipfile.ZIP_DEFLATED
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            zip64 = s.st_size >= zipfile.ZIP64_LIMIT
+            output.write(info.FileHeader(zip64))
+            crc = compress_size = 0
+            for data in archive_blocks(f, s.st_size):
+                crc = zlib.crc32(data, crc)
+                if compressor is not None:
+                    data = compressor.compress(data)
+                compress_size += len(data)
+                output.write(data)
+                yield output.take()
+            if compressor is not None:
+                data = compressor.flush()
+                compress_size += len(data)
+                output.write(data)
+            info.CRC = crc & 0xffffffff
+            info.file_size = s.st_size
+            info.compress_size = compress_size
+            output.write(struct.pack('<4sLQQ' if zip64 else '<4sLLL',
+                                     'PK\x07\x08', info.CRC, compress_size,
+                                     s.st_size))
+            archive.filelist.append(info)
+        yield output.take()
+    archive.close()
+    yield output.take()
+
+
+def buffered(chunks):
+    """Join small chunks of data into blocks of at least BLOCK_SIZE
+    bytes."""
+    buffer = []
+    size = 0
+    for data in chunks:
+        buffer.append(data)
+        size += len(data)
+        if size >= BLOCK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
@@ -0,0 +1,176 @@
+"""Push notifications for job state changes, as server-sent events.
+
+The job manager publishes every state transition of a job to an
+EventBroker. Clients subscribe by sending a GET request to /api/events, which
+is served by EventStream outside of the Flask app, so open streams don't tie
+up request threads. Each transition is sent as an event of type 'job':
+
+    event: job
+    data: {"job_id": 123, "previous": "waiting", "status": "running"}
+
+"previous" is null for new jobs.
+"""
+
+import json
+
+from itsdangerous import BadSignature
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+
+def session_user(app, request):
+    """Get the id of the user logged in to the Flask app 'app' who sent the
+    Twisted request 'request', or None."""
+    cookie = request.getCookie(app.session_cookie_name)
+    if cookie is None:
+        return None
+    serializer = app.session_interface.get_signing_serializer(app)
+    if serializer is None:
+        return None
+    max_age = int(app.permanent_session_lifetime.total_seconds())
+    try:
+        session = serializer.loads(cookie, max_age=max_age)
+    except BadSignature:
+        return None
+    return session.get('user_id')
+
+
+class EventBroker:
+
+    """Passes job state transitions on to subscribers.
+
+    Subscribers are called on the reactor thread with a dictionary with the
+    'job_id', 'user_id', 'previous' and 'status' of the job."""
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+    def publish(self, **event):
+        """Publish an event. Can be called from any thread."""
+        if self.subscribers:
+            reactor.callFromThread(self._deliver, event)
+
+    def _deliver(self, event):
+        for subscriber in list(self.subscribers):
+            subscriber(event)
+
+
+class Subscription:
+
+    """Sends the events for the jobs of the user with id 'user_id' and the
+    jobs with ids in 'job_ids' to a client; filters that are None don't
+    apply."""
+
+    def __init__(self, request, user_id=None, job_ids=None):
+        self.request = request
+        self.user_id = user_id
+        self.job_ids = job_ids
+
+    def __call__(self, event):
+        if self.user_id is not None and event['user_id'] != self.user_id:
+            return
+        if self.job_ids is not None and event['job_id'] not in self.job_ids:
+            return
+        data = {'job_id': event['job_id'],
+                'previous': event['previous'],
+                'status': event['status']}
+        self.request.write('event: job\ndata: %s\n\n' % json.dumps(data))
+
+    def keep_alive(self):
+        # comment line, so proxies don't close idle connections
+        self.request.write(':\n\n')
+
+
+class EventStream(Resource):
+
+    """Resource for streams of server-sent events.
+
+    Clients have to be logged in to the Flask app 'app'. The query
+    parameters 'user' (a username) and 'job_id' (a comma-separated list of
+    job ids) restrict the events that are sent. A comment is sent every
+    'keep_alive' seconds to keep idle connections open."""
+
+    isLeaf = True
+
+    def __init__(self, app, broker, pool, keep_alive=15):
+        Resource.__init__(self)
+        self.app = app
+        self.broker = broker
+        self.pool = pool
+        self.subscriptions = []
+        LoopingCall(self.keep_alive).start(keep_alive, now=False)
+
+    def render_GET(self, request):
+        if session_user(self.app, request) is None:
+            return self.error(request, 401, 'You have to log in first.')
+        user_id = None
+        user = request.args.get('user', [None])[0]
+        if user is not None:
+            with self.pool.borrow() as db:
+                c = db.cursor()
+                c.execute("SELECT user_id FROM user WHERE username=?",
+                          (user,))
+                row = c.fetchone()
+            if row is None:
+                return self.error(request, 404, 'No such user: %s' % user)
+            user_id = row[0]
+        job_ids = None
+        if 'job_id' in request.args:
+            try:
+                job_ids = set(int(i) for i in
+                              request.args['job_id'][0].split(',') if i)
+            except ValueError:
+                return self.error(request, 400, 'Invalid parameter: job_id')
+
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.write(':\n\n')
+        subscription = Subscription(request, user_id, job_ids)
+        self.broker.subscribe(subscription)
+        self.subscriptions.append(subscription)
+        def finished(result):
+            self.broker.unsubscribe(subscription)
+            self.subscriptions.remove(subscription)
+        request.notifyFinish().addBoth(finished)
+        return NOT_DONE_YET
+
+    def error(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({'message': message})
+
+    def keep_alive(self):
+        for subscription in self.subscriptions:
+            subscription.keep_alive()
+
+
+class SiteRoot(Resource):
+
+    """Root resource of the site: serves the resource 'events' at 'path',
+    requests that wait for output with 'output' (see 'longpoll.OutputPoll')
+    and everything else with the WSGI resource 'wsgi'."""
+
+    isLeaf = True
+
+    def __init__(self, wsgi, events, output, path='/api/events'):
+        Resource.__init__(self)
+        self.wsgi = wsgi
+        self.events = events
+        self.output = output
+        self.path = path
+
+    def render(self, request):
+        if request.path == self.path:
+            return self.events.render(request)
+        if self.output.handles(request):
+            return self.output.render(request)
+        return self.wsgi.render(request)
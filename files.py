@@ -5,11 +5,36 @@ paths relative to the user's directory are prefixed with 'r_'.
 """
 
 from datetime import datetime
+from fnmatch import translate
 import os
+import re
 import shutil
+import stat
+import time
 
 from flask import g
 
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 needs the 'scandir' package; without it, directories are
+    # read with os.listdir and os.stat
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# sort keys for directory listings, applied to (name, mtime, size) tuples;
+# directories have no size and come before files when sorting by size
+SORT_KEYS = {'name': lambda e: e[0],
+             'mtime': lambda e: (e[1], e[0]),
+             'size': lambda e: (-1 if e[2] is None else e[2], e[0])}
+
+# cached directory contents: absolute path -> (directory mtime, time read,
+# entries)
+_listing_cache = {}
+
 
 def absolute(r_path):
     """Return absolute path for a path in the user's directory."""
@@ -24,6 +49,28 @@ def is_directory(r_path):
     return os.path.isdir(absolute(r_path))
 
 
+def make_info(name, mtime, size):
+    """Build the dictionary returned by 'file_info' from a file's name, its
+    time of last modification in seconds since the epoch, and its size (None
+    for directories)."""
+    info = {}
+    info['name'] = name
+    info['mtime'] = datetime.fromtimestamp(mtime)
+    if size is None:
+        info['type'] = 'dir'
+    else:
+        info['type'] = 'file'
+        info['size'] = size
+    return info
+
+
+def stat_entry(name, s):
+    """Return a directory entry tuple (name, mtime, size) for a stat
+    result."""
+    size = None if stat.S_ISDIR(s.st_mode) else s.st_size
+    return (name, int(s.st_mtime), size)
+
+
 def file_info(r_path):
     """Get information on a file and return it in a dictionary.
 
@@ -35,30 +82,78 @@ def file_info(r_path):
     size: file size in bytes (not present for directories)
     """
     path = absolute(r_path)
-    info = {}
-    s = os.stat(path)
-    info['name'] = os.path.basename(path)
-    mtime = datetime.fromtimestamp(s.st_mtime)
-    mtime = mtime.replace(microsecond=0)
-    info['mtime'] = mtime
-    if os.path.isdir(path):
-        info['type'] = 'dir'
+    return make_info(*stat_entry(os.path.basename(path), os.stat(path)))
+
+
+def scan_directory(path):
+    """Read the directory 'path' and return a list of (name, mtime, size)
+    tuples for its entries, as for 'make_info'. Hidden files and entries
+    that can't be read (e.g. broken links) are left out."""
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                # on most systems this is the only system call per entry
+                entries.append(stat_entry(entry.name, entry.stat()))
+            except OSError:
+                pass
     else:
-        info['type'] = 'file'
-        info['size'] = s.st_size
-    return info
-
-
-def directory_listing(r_path):
+        for name in os.listdir(path):
+            if name.startswith('.'):
+                continue
+            try:
+                entries.append(stat_entry(name, os.stat(os.path.join(path,
+                                                                     name))))
+            except OSError:
+                pass
+    return entries
+
+
+def read_directory(path):
+    """Get the entries of the directory 'path' from 'scan_directory'.
+
+    If the LISTING_CACHE_TTL setting is non-zero, the entries are cached for
+    that many seconds, or until the directory's mtime changes. Since changes
+    to files don't change the directory's mtime, their size and mtime in a
+    cached listing may be out of date until it expires.
+    """
+    ttl = g.config.get('LISTING_CACHE_TTL')
+    if not ttl:
+        return scan_directory(path)
+    mtime = os.stat(path).st_mtime
+    now = time.time()
+    cached = _listing_cache.get(path)
+    if cached is not None and cached[0] == mtime and now - cached[1] < ttl:
+        return cached[2]
+    entries = scan_directory(path)
+    for p, (_, read_time, _) in list(_listing_cache.items()):
+        if now - read_time >= ttl:
+            _listing_cache.pop(p, None)
+    _listing_cache[path] = (mtime, now, entries)
+    return entries
+
+
+def directory_listing(r_path, sort='name', reverse=False, pattern=None,
+                      offset=0, limit=None):
     """Get a directory listing.
 
-    Return a list of dictionary objects, as returned by 'file_info'.
+    Return a list of dictionary objects, as returned by 'file_info', and the
+    number of entries that match the glob 'pattern' (all of them if it's
+    None). The entries are sorted by 'sort' ('name', 'mtime' or 'size'),
+    optionally in reverse, and only 'limit' of them (all if None) are
+    returned, starting at 'offset'.
     """
-    path = absolute(r_path)
-    files = os.listdir(path)
-    return [file_info(os.path.join(r_path, f))
-            for f in files
-            if not f.startswith('.')]
+    if sort not in SORT_KEYS:
+        raise ValueError('Invalid sort key: %s' % sort)
+    entries = read_directory(absolute(r_path))
+    if pattern is not None:
+        match = re.compile(translate(pattern)).match
+        entries = [e for e in entries if match(e[0])]
+    entries = sorted(entries, key=SORT_KEYS[sort], reverse=reverse)
+    end = None if limit is None else offset + limit
+    return [make_info(*e) for e in entries[offset:end]], len(entries)
 
 
 def copy_file(r_src, r_dst):
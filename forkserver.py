@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""Run scripts in child processes of a warm interpreter.
+
+This is started by the server (see 'warm.WarmPool') with the script
+interpreter, which has to be Python (2 or 3):
+
+    python forkserver.py [--preload MODULE,...]
+
+It imports the modules to preload and then reads requests from standard in,
+one at a time. A request is a line with a JSON object with the job's
+'token', 'directory', the 'size' of the script in bytes and optionally the
+resource limits 'memory', 'cpu' and 'files' (see 'supervise.py'), followed by
+the script itself. The script is run in a forked child process, in a new
+session, with the given working directory and limits, and writes to the
+fork server's standard out and error. A JSON object with the child's 'pid'
+is written to file descriptor 3 once it's started.
+
+When the child has ended, any processes left in its session are killed, the
+marker '\\0TOKEN\\0' is written to standard out and standard error, so the
+server knows where the script's output ends, and the exit status
+('returncode', negative for a signal) and resource usage are written to file
+descriptor 3 as another JSON object. The fork server exits when standard in
+is closed.
+"""
+
+import argparse
+import atexit
+import errno
+import json
+import os
+import resource
+import signal
+import sys
+import traceback
+
+
+def report(message):
+    os.write(3, (json.dumps(message) + '\n').encode('ascii'))
+
+
+def read_request(stdin):
+    """Read a request and return it with the script, or (None, None) if
+    standard in was closed."""
+    line = stdin.readline()
+    if not line:
+        return None, None
+    request = json.loads(line.decode('utf-8'))
+    script = stdin.read(request['size'])
+    return request, script
+
+
+def exit_status(code):
+    """Convert the argument of sys.exit to an exit status, like Python
+    does."""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code & 0xff
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+
+def run_script(request, script):
+    """Run a script in the child process and return its exit status."""
+    os.setsid()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.close(3)
+    sys.stdin = open(os.devnull)
+    os.chdir(request['directory'])
+    limits = [(resource.RLIMIT_AS, request.get('memory')),
+              (resource.RLIMIT_CPU, request.get('cpu')),
+              (resource.RLIMIT_NOFILE, request.get('files'))]
+    for limit, value in limits:
+        if value is not None:
+            resource.setrlimit(limit, (value, value))
+    sys.argv = ['']
+    namespace = {'__name__': '__main__', '__builtins__': __builtins__}
+    try:
+        exec(compile(script, '<stdin>', 'exec'), namespace)
+        status = 0
+    except SystemExit as e:
+        status = exit_status(e.code)
+    except BaseException:
+        # leave out the frame of this function, like the interpreter would
+        error_type, error, tb = sys.exc_info()
+        traceback.print_exception(error_type, error, tb.tb_next)
+        status = 1
+    try:
+        atexit._run_exitfuncs()
+    except BaseException:
+        status = status or 1
+    for f in (sys.stdout, sys.stderr):
+        try:
+            f.flush()
+        except (IOError, OSError, ValueError):
+            pass
+    return status
+
+
+def wait(pid):
+    """Wait for a process to end and return its status and resource usage."""
+    while True:
+        try:
+            _, status, usage = os.wait4(pid, 0)
+            return status, usage
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run scripts in child '
+                                                 'processes of a warm '
+                                                 'interpreter.')
+    parser.add_argument('--preload', default='',
+                        help='comma-separated list of modules to import')
+    options = parser.parse_args()
+    for name in options.preload.split(','):
+        if name:
+            __import__(name)
+
+    stdin = os.fdopen(0, 'rb')
+    while True:
+        request, script = read_request(stdin)
+        if request is None:
+            break
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = run_script(request, script)
+            finally:
+                os._exit(status)
+        report({'pid': pid})
+        status, usage = wait(pid)
+        try:
+            # don't let processes the script left behind write to the
+            # output of the next script
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        marker = ('\0%s\0' % request['token']).encode('ascii')
+        os.write(1, marker)
+        os.write(2, marker)
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        report({'returncode': returncode,
+                'max_rss': usage.ru_maxrss,
+                'user_time': usage.ru_utime,
+                'sys_time': usage.ru_stime})
+
+
+if __name__ == '__main__':
+    main()
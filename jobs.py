@@ -1,54 +1,337 @@
-from contextlib import closing
 from datetime import datetime
+import os
+import threading
+import time
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import log
 
 import database
+import output
 import process
+import retry
+import scheduler
+import scripts
 
 
-def make_callback(job_manager, dbname, job_id):
-    def callback(success, out, err):
-        with closing(database.connect(dbname)) as db:
-            job_manager.process_terminated(db, job_id, success, out, err)
+def make_callback(job_manager, job_id):
+    def callback(success, out, err, usage=None):
+        job_manager.process_terminated(job_id, success, out, err, usage)
     return callback
 
 
+def _job_filter(status=None, user=None, since=None, until=None,
+                from_id=None, to_id=None, job_ids=None):
+    """Return a list of SQL conditions and a list of parameters to select the
+    jobs with the given status, owned by the user with the given username,
+    submitted in the given time range (ISO 8601 timestamps), with ids in
+    the given range (inclusive), or with ids in the list 'job_ids'."""
+    where = []
+    params = []
+    if job_ids is not None:
+        where.append('job_id IN (%s)' % ', '.join('?' * len(job_ids)))
+        params.extend(job_ids)
+    if status is not None:
+        where.append('status = ?')
+        params.append(status)
+    if user is not None:
+        where.append('user_id = (SELECT user_id FROM user WHERE username = ?)')
+        params.append(user)
+    if since is not None:
+        where.append('submit_time >= datetime(?)')
+        params.append(since)
+    if until is not None:
+        where.append('submit_time < datetime(?)')
+        params.append(until)
+    if from_id is not None:
+        where.append('job_id >= ?')
+        params.append(from_id)
+    if to_id is not None:
+        where.append('job_id <= ?')
+        params.append(to_id)
+    return where, params
+
+
+def stored_output(o, compression=None, level=6):
+    """Return (text, spool file, size) to store in the job table for an
+    output object. Output kept in memory is compressed if 'compression' is
+    one of the methods in 'output.COMPRESSION'."""
+    if o.path is not None:
+        return None, o.path, o.size
+    if compression is None:
+        return o.getvalue(), None, o.size
+    return buffer(output.compress(o.getvalue(), compression, level)), None, \
+        o.size
+
+
 class JobManager:
 
     """A job manager keeps a database of jobs and takes care of starting and
-    supervising running jobs."""
+    supervising running jobs. Database connections for callbacks are taken
+    from 'pool' (see 'database.ConnectionPool').
+
+    If 'output_dir' is given, the output of running jobs is spooled to files
+    in that directory and the database only stores the file names; otherwise
+    it's kept in memory and stored in the database when the job ends,
+    compressed with 'compression' (one of the methods in
+    'output.COMPRESSION') at 'compression_level' unless that is None.
+
+    Waiting jobs are kept in an in-memory queue (see 'scheduler.JobQueue' for
+    the meaning of 'scheduling' and 'max_running_per_user'), which is loaded
+    from the database on startup and kept in sync as jobs are added and
+    started, so the database is only used to record state transitions.
+
+    State transitions are written to the database by a 'database.Writer',
+    so neither the reactor thread nor request threads wait for commits, and
+    transitions that happen close together are committed at once. Since
+    there's a single writer, transitions are recorded in the order they
+    happen. Once a transition is committed, the queue and the job counts are
+    updated on the reactor thread, and the transition is published (see
+    '_apply'). The queue and the set of running jobs are protected by a
+    lock, since they're also read from request threads.
+
+    The job manager also keeps count of the jobs in each state. The counts
+    are taken from the database on startup and then updated with every state
+    transition, so they can be looked up without querying the database. If
+    'events' is an 'events.EventBroker', every state transition is also
+    published there once it's recorded in the database.
+
+    Up to 'max_running' jobs (any number if it's None) are run as processes
+    on the server; 'adjust_max_running' can change that limit while the
+    server is running. If 'workers' is a 'workers.WorkerPool', jobs are also
+    sent to remote workers, which are preferred while they have free slots.
+
+    'limits' (see 'process.Limits') applies to all jobs, wherever they run;
+    the resource usage it records is stored with the job.
+
+    'recovery' decides what happens to jobs that are still running when the
+    server stops (see 'shutdown'): with 'fail', they're killed and marked as
+    failed; with 'requeue', they're killed and put back in the queue; with
+    'adopt', jobs running on the server are detached from it (see
+    'process.spawn'), keep running and are adopted when it starts again,
+    while jobs on workers are put back in the queue. 'adopt' requires
+    'output_dir'.
+
+    If 'warm' is a 'warm.WarmPool', jobs on the server are run by its fork
+    servers while they're available, instead of starting a new interpreter
+    for each job. Jobs that are detached for adoption always get their own
+    interpreter.
+
+    Failed jobs are retried according to 'retry_policy' (see
+    'retry.RetryPolicy'; by default, they aren't). While a job waits for its
+    next attempt, its status is 'retrying'. Every attempt is recorded in the
+    job's attempt history."""
+
+    RECOVERY = ['fail', 'requeue', 'adopt']
 
-    def __init__(self, cmd, args, dbname, max_running):
-        self.cmd = cmd
-        self.args = args
-        self.dbname = dbname
-        self.max_running = max_running
+    # seconds to wait before trying again if a job's state couldn't be
+    # recorded
+    WRITE_RETRY_DELAY = 10
+
+    def __init__(self, cmd, args, pool, max_running, output_dir=None,
+                 output_buffer_size=64*1024, output_flush_interval=1.0,
+                 scheduling='fifo', max_running_per_user=None,
+                 compression=None, compression_level=6, workers=None,
+                 limits=None, events=None, recovery='fail',
+                 retry_policy=None, warm=None):
+        if recovery not in self.RECOVERY:
+            raise ValueError('Unknown recovery mode: %s' % recovery)
+        if recovery == 'adopt' and output_dir is None:
+            raise ValueError("Recovery mode 'adopt' requires an output "
+                             "directory")
+        self.pool = pool
+        self.limits = limits
+        self.events = events
+        self.recovery = recovery
+        self.retry_policy = retry_policy or retry.RetryPolicy()
+        self.stopping = False
+        self.local = process.LocalExecutor(cmd, args, max_running, warm)
+        self.executors = [self.local]
+        if workers is not None:
+            workers.job_lost = self.requeue_job
+            workers.capacity_changed = self.check_queue
+            self.executors.insert(0, workers)
+        self.output_dir = None
+        if output_dir is not None:
+            self.output_dir = os.path.abspath(output_dir)
+            if not os.path.isdir(self.output_dir):
+                os.makedirs(self.output_dir)
+        self.output_buffer_size = output_buffer_size
+        self.output_flush_interval = output_flush_interval
+        if compression is not None and compression not in output.COMPRESSION:
+            raise ValueError('Unknown compression method: %s' % compression)
+        if compression is not None and compression_level not in range(1, 10):
+            raise ValueError('Invalid compression level: %r'
+                             % (compression_level,))
+        self.compression = compression
+        self.compression_level = compression_level
         self.running = {}
-        with closing(database.connect(dbname)) as db:
-            # clean up the database after the server was restarted
+        # jobs that have ended, until that's recorded in the database
+        self.ending = {}
+        self.queue = scheduler.JobQueue(scheduling, max_running_per_user)
+        self.lock = threading.RLock()
+        self.writer = database.Writer(pool)
+        with pool.borrow() as db:
+            # recover the jobs that were running when the server stopped
             c = db.cursor()
-            c.execute("UPDATE job SET status='failed' WHERE status='running'")
+            c.execute("""SELECT job_id, user_id, pid FROM job
+                         WHERE status='running'""")
+            for job_id, user_id, pid in c.fetchall():
+                self._recover(c, job_id, user_id, pid)
+            db.commit()
+            c.execute("""SELECT job_id, user_id, priority FROM job
+                         WHERE status='waiting'""")
+            for job_id, user_id, priority in c.fetchall():
+                self.queue.push(job_id, user_id, priority)
+            self.counts = self._count_in_database(db)
+            # jobs whose parents ended while the server was down
+            c.execute("SELECT job_id FROM job WHERE status='blocked'")
+            transitions = self._update_blocked(db, [row[0] for row in
+                                                    c.fetchall()])
             db.commit()
+            self._apply(transitions)
+            # retries that were due while the server was down are started
+            # right away
+            c.execute("""SELECT job_id,
+                                (julianday(retry_time) - julianday('now'))
+                                * 86400
+                         FROM job WHERE status='retrying'""")
+            for job_id, delay in c.fetchall():
+                reactor.callLater(max(delay or 0, 0), self.retry_job, job_id)
             self._check_queue(db)
 
-    def new_job(self, db, user_id, script):
-        """Add a new job and return the job id."""
+    def new_job(self, db, user_id, script, priority=0, depends_on=(),
+                max_attempts=None):
+        """Add a new job and return the job id.
+
+        Jobs with a higher priority are started first. A job that depends on
+        other jobs (given by their ids in 'depends_on') is blocked until all
+        of them are done, and cancelled if any of them fails or is
+        cancelled. 'max_attempts' overrides the retry policy's maximum
+        number of attempts for the job."""
+        return self.new_jobs(db, user_id, [script], priority, depends_on,
+                             max_attempts)[0]
+
+    def new_jobs(self, db, user_id, job_scripts, priority=0, depends_on=(),
+                 max_attempts=None):
+        """Add a job for each script in a list and return the list of job
+        ids. All jobs are added in a single transaction.
+
+        Raises ValueError if one of the jobs in 'depends_on' doesn't exist.
+        Must not be called on the reactor thread, since it waits for the
+        jobs to be recorded."""
+        transitions = threads.blockingCallFromThread(
+            reactor, self._record, self._insert_jobs, user_id, job_scripts,
+            priority, sorted(set(depends_on)), max_attempts)
+        return [job_id for job_id, user_id, priority, old, new in transitions]
+
+    def _insert_jobs(self, db, user_id, job_scripts, priority, depends_on,
+                     max_attempts):
+        """Insert new jobs and return their transitions (see '_apply')."""
         c = db.cursor()
-        c.execute("INSERT INTO job (user_id, script) VALUES (?, ?)",
-                  (user_id, buffer(script)))
-        job_id = c.lastrowid
-        db.commit()
-        self._check_queue(db)
-        return job_id
-
-    def list_jobs(self, db):
-        """Get a list of all jobs in the database."""
+        digests = [scripts.store(c, script) for script in job_scripts]
+        # since the writer runs one update at a time, the parents can't end
+        # between checking their status and adding the dependencies
+        status = self._initial_status(c, depends_on)
+        transitions = []
+        for digest in digests:
+            c.execute("""INSERT INTO job
+                             (user_id, script_digest, priority, status,
+                              max_attempts, submit_time, end_time)
+                         VALUES (?, ?, ?, ?, ?, datetime('now'),
+                                 CASE WHEN ? = 'cancelled'
+                                      THEN datetime('now') END)""",
+                      (user_id, digest, priority, status, max_attempts,
+                       status))
+            transitions.append((c.lastrowid, user_id, priority, None, status))
+        c.executemany("""INSERT INTO job_dependency (job_id, parent_id)
+                         VALUES (?, ?)""",
+                      [(t[0], parent_id) for t in transitions
+                       for parent_id in depends_on])
+        return transitions
+
+    def _initial_status(self, c, depends_on):
+        """Get the status of a new job that depends on the jobs with the
+        given ids."""
+        if not depends_on:
+            return 'waiting'
+        c.execute("SELECT job_id, status FROM job WHERE job_id IN (%s)"
+                  % ', '.join('?' * len(depends_on)),
+                  depends_on)
+        statuses = dict(c.fetchall())
+        for parent_id in depends_on:
+            if parent_id not in statuses:
+                raise ValueError('No such job: %d' % parent_id)
+        if any(s in ('failed', 'cancelled') for s in statuses.values()):
+            return 'cancelled'
+        if all(s == 'done' for s in statuses.values()):
+            return 'waiting'
+        return 'blocked'
+
+    def list_jobs(self, db, after_id=None, limit=None, **filters):
+        """Get a list of jobs in the database, ordered by job id.
+
+        Only jobs with an id greater than 'after_id' are listed, and at most
+        'limit' of them. The list can be filtered with the keyword arguments
+        described in '_job_filter'."""
+        where, params = _job_filter(**filters)
+        if after_id is not None:
+            where.append('job_id > ?')
+            params.append(after_id)
+        sql = """SELECT job_id, username, status,
+                        submit_time as "submitted [timestamp]"
+                 FROM job NATURAL JOIN user"""
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY job_id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
         c = db.cursor()
-        result = c.execute("""SELECT job_id, username, status
-                              FROM job NATURAL JOIN user
-                              ORDER BY job_id""")
-        return [{'job_id': row[0], 'user': row[1], 'status': row[2]}
+        result = c.execute(sql, params)
+        return [{'job_id': row[0], 'user': row[1], 'status': row[2],
+                 'submitted': None if row[3] is None else row[3].isoformat()}
                 for row in result]
 
+    def count_matching_jobs(self, db, **filters):
+        """Count the jobs matching the filters described in '_job_filter'.
+
+        Without filters, or filtering by status only, the jobs are counted
+        in memory; other filters need the database."""
+        status = filters.get('status')
+        if all(value is None for name, value in filters.items()
+               if name != 'status'):
+            with self.lock:
+                if status is not None:
+                    return self.counts.get(status, 0)
+                return sum(self.counts.values())
+        where, params = _job_filter(**filters)
+        sql = 'SELECT COUNT(job_id) FROM job'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        c = db.cursor()
+        c.execute(sql, params)
+        return c.fetchone()[0]
+
+    def find_jobs(self, db, job_ids=None, **filters):
+        """Get the ids of the jobs matching the keyword arguments described
+        in '_job_filter'. Lists of 'job_ids' are looked up in batches."""
+        if job_ids is None:
+            batches = [None]
+        else:
+            job_ids = sorted(set(job_ids))
+            batches = [job_ids[i:i+500] for i in range(0, len(job_ids), 500)]
+        c = db.cursor()
+        found = []
+        for batch in batches:
+            where, params = _job_filter(job_ids=batch, **filters)
+            sql = "SELECT job_id FROM job"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            c.execute(sql + " ORDER BY job_id", params)
+            found.extend(row[0] for row in c.fetchall())
+        return found
+
     def is_job(self, db, job_id):
         """Check if there is a job with the given id in the database."""
         c = db.cursor()
@@ -59,25 +342,126 @@ class JobManager:
     def get_job(self, db, job_id):
         """Get information on a job in the database."""
         c = db.cursor()
-        c.execute("""SELECT job_id, username, status, script,
+        c.execute("""SELECT job_id, username, status, priority,
+                            script_digest, content,
+                            submit_time as "submitted [timestamp]",
                             start_time as "start [timestamp]",
                             end_time as "end [timestamp]",
-                            out, err
+                            out, err, out_file, err_file, out_bytes, err_bytes,
+                            compression, max_rss, user_time, sys_time,
+                            max_attempts,
+                            retry_time as "retry [timestamp]"
                      FROM job NATURAL JOIN user
+                          JOIN script ON script.digest = job.script_digest
                      WHERE job_id = ?""",
                   (job_id,))
         row = c.fetchone()
         if row is None:
             return None
-        (job_id, user, status, script, start, end, out, err) = row
+        (job_id, user, status, priority, digest, script, submitted, start, end,
+         out, err, out_file, err_file, out_bytes, err_bytes,
+         compression, max_rss, user_time, sys_time, max_attempts,
+         retry_time) = row
+        if compression is not None:
+            out = output.decompress(str(out), compression)
+            err = output.decompress(str(err), compression)
+        if out_file is not None:
+            out = output.read_spool(out_file)
+        if err_file is not None:
+            err = output.read_spool(err_file)
         return {'job_id': job_id,
                 'user': user,
                 'status': status,
+                'priority': priority,
                 'script': str(script),
+                'script_digest': digest,
+                'submitted': (None if submitted is None
+                              else submitted.isoformat()),
                 'start': None if start is None else start.isoformat(),
                 'end': None if end is None else end.isoformat(),
                 'out': out,
-                'err': err}
+                'err': err,
+                'out_bytes': out_bytes,
+                'err_bytes': err_bytes,
+                'max_rss': max_rss,
+                'user_time': user_time,
+                'sys_time': sys_time,
+                'depends_on': self._parents(c, job_id),
+                'max_attempts': (self.retry_policy.max_attempts
+                                 if max_attempts is None else max_attempts),
+                'retry': (None if retry_time is None
+                          else retry_time.isoformat()),
+                'attempts': self._attempts(c, job_id)}
+
+    def _parents(self, c, job_id):
+        """Get the ids of the jobs a job depends on."""
+        c.execute("""SELECT parent_id FROM job_dependency WHERE job_id=?
+                     ORDER BY parent_id""",
+                  (job_id,))
+        return [row[0] for row in c.fetchall()]
+
+    def _attempts(self, c, job_id):
+        """Get the history of a job's finished attempts."""
+        c.execute("""SELECT attempt,
+                            start_time as "start [timestamp]",
+                            end_time as "end [timestamp]",
+                            returncode, max_rss, user_time, sys_time
+                     FROM job_attempt WHERE job_id=?
+                     ORDER BY attempt""",
+                  (job_id,))
+        return [{'attempt': attempt,
+                 'start': None if start is None else start.isoformat(),
+                 'end': None if end is None else end.isoformat(),
+                 'returncode': returncode,
+                 'max_rss': max_rss,
+                 'user_time': user_time,
+                 'sys_time': sys_time}
+                for (attempt, start, end, returncode, max_rss, user_time,
+                     sys_time) in c.fetchall()]
+
+    def get_output(self, job_id, stream):
+        """Get the output object (see 'output.Output') of a running job on
+        'stream' ('out' or 'err'), or None if the job isn't running."""
+        job = self.running.get(job_id) or self.ending.get(job_id)
+        if job is None:
+            return None
+        return getattr(job, stream)
+
+    def read_output(self, db, job_id, stream, offset, size=None):
+        """Read a job's output on 'stream' ('out' or 'err'), starting at byte
+        'offset' and returning at most 'size' bytes.
+
+        Returns a (status, data) tuple, or None if there is no such job."""
+        o = self.get_output(job_id, stream)
+        if o is not None:
+            return 'running', o.read(offset, size)
+        c = db.cursor()
+        c.execute("""SELECT status, %s_file, compression
+                     FROM job WHERE job_id = ?""" % stream,
+                  (job_id,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        status, path, compression = row
+        if path is not None:
+            data = output.read_spool(path, offset, size)
+        elif compression is not None:
+            # compressed output has to be read completely
+            c.execute("SELECT %s FROM job WHERE job_id = ?" % stream,
+                      (job_id,))
+            data = output.decompress(str(c.fetchone()[0]), compression)
+            data = data[offset:None if size is None else offset + size]
+        elif size is None:
+            c.execute("""SELECT substr(CAST(%s AS BLOB), ?)
+                         FROM job WHERE job_id = ?""" % stream,
+                      (offset + 1, job_id))
+            data = c.fetchone()[0]
+        else:
+            c.execute("""SELECT substr(CAST(%s AS BLOB), ?, ?)
+                         FROM job WHERE job_id = ?""" % stream,
+                      (offset + 1, size, job_id))
+            data = c.fetchone()[0]
+        return status, '' if data is None else str(data)
 
     def get_job_owner(self, db, job_id):
         """Get the job's owner's user_id."""
@@ -88,10 +472,7 @@ class JobManager:
 
     def count_jobs(self, db, status):
         """Count the number of jobs with the given status."""
-        c = db.cursor()
-        c.execute("SELECT COUNT(job_id) FROM job WHERE status = ?", (status,))
-        row = c.fetchone()
-        return row[0]
+        return self.counts.get(status, 0)
 
     def terminateJob(self, db, job_id):
         """Ask the job to terminate."""
@@ -101,40 +482,560 @@ class JobManager:
         """Kill the job."""
         self.running[job_id].kill()
 
-    def process_terminated(self, db, job_id, success, out, err):
-        """Called after a job terminates."""
-        del self.running[job_id]
+    def cancel_jobs(self, db, job_ids):
+        """Cancel the waiting, blocked and retrying jobs among the jobs with
+        the given ids, and the blocked jobs that depend on them.
+
+        Returns the ids of the cancelled jobs, not counting the dependents.
+        Must not be called on the reactor thread."""
+        job_ids = set(job_ids)
+        transitions = threads.blockingCallFromThread(
+            reactor, self._record, self._cancel, sorted(job_ids))
+        return [t[0] for t in transitions if t[0] in job_ids]
+
+    def _cancel(self, db, job_ids):
+        """Mark jobs as cancelled (see 'cancel_jobs') and return the
+        transitions."""
+        c = db.cursor()
+        transitions = []
+        for i in range(0, len(job_ids), 500):
+            batch = job_ids[i:i+500]
+            c.execute("""SELECT job_id, user_id, priority, status FROM job
+                         WHERE job_id IN (%s)
+                           AND status IN ('waiting', 'blocked', 'retrying')"""
+                      % ', '.join('?' * len(batch)),
+                      batch)
+            transitions.extend(row + ('cancelled',) for row in c.fetchall())
+        c.executemany("""UPDATE job
+                         SET status='cancelled', end_time=datetime('now'),
+                             retry_time=NULL
+                         WHERE job_id=?""",
+                      [(t[0],) for t in transitions])
+        dependents = []
+        for t in transitions:
+            c.execute("SELECT job_id FROM job_dependency WHERE parent_id=?",
+                      (t[0],))
+            dependents.extend(row[0] for row in c.fetchall())
+        return transitions + self._update_blocked(db, dependents)
+
+    def terminate_jobs(self, db, job_ids, kill=False):
+        """Ask the running jobs among the jobs with the given ids to
+        terminate, or kill them if 'kill' is true.
+
+        Returns the ids of the jobs that were running."""
+        signalled = []
+        with self.lock:
+            for job_id in job_ids:
+                job = self.running.get(job_id)
+                if job is None:
+                    continue
+                if kill:
+                    job.kill()
+                else:
+                    job.terminate()
+                signalled.append(job_id)
+        return signalled
+
+    def process_terminated(self, job_id, success, out, err, usage=None):
+        """Called on the reactor thread after a job terminates.
+
+        'usage' is the job's resource usage (see 'process.RunScriptProtocol')
+        or None. A failed job is retried if the retry policy says so."""
+        with self.lock:
+            job = self.running.pop(job_id, None)
+            if job is None:
+                # put back in the queue by 'shutdown' or '_start_failed'
+                return
+            self.ending[job_id] = job
+            user_id = self.queue.running.get(job_id)
+            self.queue.finished(job_id)
+        d = self.writer.run(self._record_end, job_id, user_id, success, out,
+                            err, usage)
+        d.addCallbacks(self._ended, self._end_failed, callbackArgs=(job_id,),
+                       errbackArgs=(job_id,))
+        d.addErrback(log.err)
+
+    def _record_end(self, db, job_id, user_id, success, out, err, usage):
+        """Record the end of a job and release or cancel its dependents.
+
+        Returns the delay before the job is retried (None if it isn't) and
+        the transitions, or None if the job wasn't running, because it was
+        cancelled while it was being started."""
         c = db.cursor()
-        status = 'done' if success else 'failed'
+        c.execute("""SELECT status, max_attempts,
+                            (SELECT COUNT(*) FROM job_attempt
+                             WHERE job_attempt.job_id = job.job_id)
+                     FROM job WHERE job_id=?""",
+                  (job_id,))
+        row = c.fetchone()
+        if row is None or row[0] != 'running':
+            return None
+        max_attempts, attempts = row[1:]
+        returncode = usage and usage.get('returncode')
+        delay = None
+        if not success:
+            delay = self.retry_policy.retry_delay(attempts + 1, returncode,
+                                                  max_attempts)
+        if success:
+            status = 'done'
+        elif delay is None:
+            status = 'failed'
+        else:
+            status = 'retrying'
+        compression = None if out.path is not None else self.compression
+        out_text, out_file, out_bytes = \
+            stored_output(out, compression, self.compression_level)
+        err_text, err_file, err_bytes = \
+            stored_output(err, compression, self.compression_level)
         c.execute("""UPDATE job
-                     SET status=?, end_time=datetime('now'), out=?, err=?
+                     SET status=?, end_time=datetime('now'), out=?, err=?,
+                         out_file=?, err_file=?, out_bytes=?, err_bytes=?,
+                         compression=?, max_rss=?, user_time=?, sys_time=?,
+                         retry_time=datetime('now', ?)
                      WHERE job_id=?""",
-                  (status, out, err, job_id))
-        db.commit()
-        self._check_queue(db)
+                  (status, out_text, err_text, out_file, err_file,
+                   out_bytes, err_bytes, compression,
+                   usage and usage.get('max_rss'),
+                   usage and usage.get('user_time'),
+                   usage and usage.get('sys_time'),
+                   None if delay is None else '+%f seconds' % delay, job_id))
+        c.execute("""INSERT INTO job_attempt
+                         (job_id, attempt, start_time, end_time, returncode,
+                          max_rss, user_time, sys_time)
+                     SELECT job_id, ?, start_time, end_time, ?,
+                            max_rss, user_time, sys_time
+                     FROM job WHERE job_id=?""",
+                  (attempts + 1, returncode, job_id))
+        c.execute("SELECT job_id FROM job_dependency WHERE parent_id=?",
+                  (job_id,))
+        transitions = [(job_id, user_id, None, 'running', status)]
+        transitions += self._update_blocked(db, [row[0] for row in
+                                                 c.fetchall()])
+        return delay, transitions
 
-    def _check_queue(self, db):
-        """Look up waiting jobs and start as many as possible."""
-        if (self.max_running is not None) and \
-           (len(self.running) >= self.max_running):
+    def _ended(self, result, job_id):
+        """Called once the end of a job is recorded."""
+        with self.lock:
+            del self.ending[job_id]
+        status_path = self._output_path(job_id, 'status')
+        if status_path is not None and os.path.exists(status_path):
+            os.remove(status_path)
+        if result is None:
             return
+        delay, transitions = result
+        if delay is not None:
+            reactor.callLater(delay, self.retry_job, job_id)
+        self._applied(transitions)
+
+    def _end_failed(self, reason, job_id):
+        """Called if the end of a job couldn't be recorded. The job stays
+        'running' in the database, and is recovered like the other jobs that
+        were running when the server is restarted (see 'RECOVERY')."""
+        log.err(reason, 'Recording the end of job %d failed' % job_id)
+        with self.lock:
+            del self.ending[job_id]
+
+    def retry_job(self, job_id):
+        """Put a job that's waiting to be retried back in the queue, unless
+        it was cancelled in the meantime."""
+        d = self._record(self._record_retry, job_id)
+        d.addErrback(self._retry_failed, job_id)
+        return d
+
+    def _retry_failed(self, reason, job_id):
+        log.err(reason, 'Retrying job %d failed' % job_id)
+        reactor.callLater(self.WRITE_RETRY_DELAY, self.retry_job, job_id)
+
+    def _record_retry(self, db, job_id):
+        """Record that a job is put back in the queue by 'retry_job'."""
         c = db.cursor()
-        c.execute("""SELECT job_id, script, directory
-                     FROM job NATURAL JOIN user
-                     WHERE status='waiting'
-                     ORDER BY job_id LIMIT 1""")
+        c.execute("""SELECT user_id, priority FROM job
+                     WHERE job_id=? AND status='retrying'""",
+                  (job_id,))
         row = c.fetchone()
         if row is None:
-            return
-        job_id, script, path = row[0], str(row[1]), row[2]
-        cmd = self.cmd
-        args = self.args
-        callback = make_callback(self, self.dbname, job_id)
-        self.running[job_id] = \
-            process.spawn(job_id, cmd, args, script, path, callback)
+            return []
         c.execute("""UPDATE job
-                     SET status='running', start_time=datetime('now')
+                     SET status='waiting', start_time=NULL, end_time=NULL,
+                         retry_time=NULL
+                     WHERE job_id=?""",
+                  (job_id,))
+        return [(job_id, row[0], row[1], 'retrying', 'waiting')]
+
+    def requeue_job(self, job_id):
+        """Put a running job back in the queue, e.g. after the worker it was
+        running on was lost."""
+        with self.lock:
+            if self.running.pop(job_id, None) is None:
+                # already put back in the queue by 'shutdown'
+                return
+            self.queue.finished(job_id)
+        d = self._record(self._record_requeue, job_id)
+        # if that fails, the job stays 'running' in the database until the
+        # server is restarted
+        d.addErrback(log.err, 'Putting job %d back in the queue failed'
+                     % job_id)
+        return d
+
+    def _record_requeue(self, db, job_id):
+        """Record that a job is put back in the queue by 'requeue_job'."""
+        c = db.cursor()
+        c.execute("""UPDATE job SET status='waiting', start_time=NULL
                      WHERE job_id=?""",
                   (job_id,))
-        db.commit()
-        self._check_queue(db)
+        c.execute("SELECT user_id, priority FROM job WHERE job_id=?",
+                  (job_id,))
+        user_id, priority = c.fetchone()
+        return [(job_id, user_id, priority, 'running', 'waiting')]
+
+    def shutdown(self, timeout=0):
+        """Stop starting jobs and wait up to 'timeout' seconds for the
+        running jobs to end. Then deal with the jobs that are still running
+        according to the recovery mode.
+
+        Returns a Deferred, so it can be used as a trigger before the reactor
+        shuts down."""
+        self.stopping = True
+        deadline = time.time() + timeout
+        def wait():
+            if (self.running or self.ending) and time.time() < deadline:
+                return task.deferLater(reactor, 0.5, wait)
+            return self._stop_jobs()
+        return defer.maybeDeferred(wait)
+
+    def _stop_jobs(self):
+        """Kill the running jobs that aren't left running for adoption and,
+        unless the recovery mode is 'fail', put them back in the queue.
+
+        Returns a Deferred that fires once that's recorded, and all the
+        updates before it."""
+        requeued = []
+        with self.lock:
+            for job_id, job in self.running.items():
+                if self.recovery == 'adopt' and job.detached:
+                    continue
+                if self.recovery != 'fail':
+                    # forget the job, so it isn't marked as failed when it
+                    # ends
+                    del self.running[job_id]
+                    requeued.append((job_id,))
+                job.kill()
+        return self.writer.run(self._record_stopped, requeued)
+
+    def _record_stopped(self, db, job_ids):
+        """Record that jobs were put back in the queue by '_stop_jobs'."""
+        db.executemany("""UPDATE job
+                          SET status='waiting', start_time=NULL, pid=NULL
+                          WHERE job_id=?""",
+                       job_ids)
+
+    def _recover(self, c, job_id, user_id, pid):
+        """Recover a job that was running when the server stopped: adopt it
+        if it's detached and still running or has ended since, otherwise
+        fail or requeue it according to the recovery mode.
+
+        Jobs that aren't adopted are killed if they're still running, and
+        the interrupted run counts as an attempt, so they're only requeued
+        while the retry policy allows it; otherwise they fail."""
+        if self.recovery == 'adopt' and pid is not None:
+            status_path = self._output_path(job_id, 'status')
+            if os.path.exists(status_path) or \
+               process.is_supervisor(pid, status_path):
+                out = output.FileOutput(self._output_path(job_id, 'out'),
+                                        truncate=False)
+                err = output.FileOutput(self._output_path(job_id, 'err'),
+                                        truncate=False)
+                callback = make_callback(self, job_id)
+                self.running[job_id] = self.local.adopt(
+                    job_id, pid, out, err, status_path, callback)
+                self.queue.add_running(job_id, user_id)
+                return
+        if pid is not None and process.is_supervisor(pid):
+            process.signal_group(pid, 'KILL')
+        c.execute("""SELECT max_attempts,
+                            (SELECT COUNT(*) FROM job_attempt
+                             WHERE job_attempt.job_id = job.job_id)
+                     FROM job WHERE job_id=?""",
+                  (job_id,))
+        max_attempts, attempts = c.fetchone()
+        c.execute("""INSERT INTO job_attempt (job_id, attempt, start_time,
+                                              end_time)
+                     SELECT job_id, ?, start_time, datetime('now')
+                     FROM job WHERE job_id=?""",
+                  (attempts + 1, job_id))
+        if self.recovery != 'fail' and \
+           self.retry_policy.may_retry(attempts + 1, max_attempts):
+            c.execute("""UPDATE job
+                         SET status='waiting', start_time=NULL, pid=NULL
+                         WHERE job_id=?""",
+                      (job_id,))
+        else:
+            c.execute("""UPDATE job
+                         SET status='failed', end_time=datetime('now'),
+                             pid=NULL
+                         WHERE job_id=?""",
+                      (job_id,))
+
+    def max_running(self):
+        """Get the number of jobs that may run on the server (None if there's
+        no limit)."""
+        return self.local.max_running
+
+    def adjust_max_running(self, monitor):
+        """Adjust the number of jobs that may run on the server to the
+        system load, as decided by 'monitor' (see 'load.LoadMonitor'), and
+        start more jobs if it went up."""
+        with self.lock:
+            current = self.local.max_running
+            self.local.max_running = monitor.limit(current, self.local.running)
+            raised = self.local.max_running > current
+        if raised:
+            self.check_queue()
+
+    def _update_blocked(self, db, job_ids):
+        """Check the blocked jobs among the jobs with the given ids: queue
+        those whose parents are all done and cancel those with a parent that
+        failed or was cancelled, along with the blocked jobs depending on
+        them. Returns the transitions, which still have to be committed and
+        applied."""
+        c = db.cursor()
+        pending = list(job_ids)
+        transitions = []
+        while pending:
+            job_id = pending.pop()
+            c.execute("""SELECT user_id, priority FROM job
+                         WHERE job_id=? AND status='blocked'""",
+                      (job_id,))
+            row = c.fetchone()
+            if row is None:
+                continue
+            user_id, priority = row
+            c.execute("""SELECT DISTINCT parent.status
+                         FROM job_dependency
+                              JOIN job AS parent
+                              ON parent.job_id = job_dependency.parent_id
+                         WHERE job_dependency.job_id=?""",
+                      (job_id,))
+            statuses = set(row[0] for row in c.fetchall())
+            if statuses & set(['failed', 'cancelled']):
+                c.execute("""UPDATE job
+                             SET status='cancelled', end_time=datetime('now')
+                             WHERE job_id=?""",
+                          (job_id,))
+                transitions.append((job_id, user_id, priority, 'blocked',
+                                    'cancelled'))
+                c.execute("""SELECT job_id FROM job_dependency
+                             WHERE parent_id=?""",
+                          (job_id,))
+                pending.extend(row[0] for row in c.fetchall())
+            elif statuses <= set(['done']):
+                c.execute("UPDATE job SET status='waiting' WHERE job_id=?",
+                          (job_id,))
+                transitions.append((job_id, user_id, priority, 'blocked',
+                                    'waiting'))
+        return transitions
+
+    def _record(self, f, *args):
+        """Record state transitions on the writer thread by calling
+        f(db, *args), which returns them, and apply them once they're
+        committed.
+
+        Returns a Deferred that fires with the transitions."""
+        d = self.writer.run(f, *args)
+        d.addCallback(self._applied)
+        return d
+
+    def _applied(self, transitions):
+        """Apply committed transitions and start jobs that may have become
+        ready."""
+        self._apply(transitions)
+        self.check_queue()
+        return transitions
+
+    def _apply(self, transitions):
+        """Update the queue and the job counts for state transitions that
+        were committed to the database, and publish them.
+
+        A transition is a (job_id, user_id, priority, old, new) tuple, where
+        'old' is None for new jobs. Jobs that become waiting are queued, and
+        waiting jobs that are cancelled are removed from the queue. If such
+        a job has been started in the meantime, starting it fails (see
+        '_started')."""
+        with self.lock:
+            for job_id, user_id, priority, old, new in transitions:
+                if new == 'waiting':
+                    self.queue.push(job_id, user_id, priority)
+                self._count_transition(old, new)
+            self.queue.remove(t[0] for t in transitions if t[3] == 'waiting')
+        for job_id, user_id, priority, old, new in transitions:
+            self._publish(job_id, user_id, old, new)
+
+    def check_queue(self):
+        """Start as many waiting jobs as possible, e.g. after more workers
+        became available."""
+        with self.pool.borrow() as db:
+            self._check_queue(db)
+
+    def _free_executor(self):
+        """Get an executor that can start another job, or None."""
+        for executor in self.executors:
+            if executor.has_free_slot():
+                return executor
+        return None
+
+    def _check_queue(self, db):
+        """Start as many waiting jobs as possible. Must be called on the
+        reactor thread, or before the reactor runs.
+
+        The jobs are recorded as running by the writer, unless they were
+        cancelled before that; see '_started'."""
+        if self.stopping:
+            return
+        with self.lock:
+            started = []
+            c = db.cursor()
+            while True:
+                executor = self._free_executor()
+                if executor is None:
+                    break
+                job_id = self.queue.pop()
+                if job_id is None:
+                    break
+                c.execute("""SELECT script_digest, directory, priority
+                             FROM job NATURAL JOIN user
+                             WHERE job_id=?""",
+                          (job_id,))
+                row = c.fetchone()
+                if row is None:
+                    self.queue.finished(job_id)
+                    self._count_transition('waiting', None)
+                    continue
+                script = scripts.load(c, row[0])
+                path, priority = row[1:]
+                callback = make_callback(self, job_id)
+                pid = None
+                if self.recovery == 'adopt' and executor is self.local:
+                    status_path = self._output_path(job_id, 'status')
+                    if os.path.exists(status_path):
+                        os.remove(status_path)
+                    out = output.FileOutput(self._output_path(job_id, 'out'))
+                    err = output.FileOutput(self._output_path(job_id, 'err'))
+                    job = executor.spawn(job_id, script, path, out, err,
+                                         callback, self.limits, status_path)
+                    pid = job.transport.pid
+                else:
+                    out = self._new_output(job_id, 'out')
+                    err = self._new_output(job_id, 'err')
+                    job = executor.spawn(job_id, script, path, out, err,
+                                         callback, self.limits)
+                    if getattr(job, 'supervised', False):
+                        # the supervisor runs in its own session, so the
+                        # job keeps running if the server crashes; its pid
+                        # is needed to kill it on recovery
+                        pid = job.transport.pid
+                self.running[job_id] = job
+                started.append((job_id, self.queue.running.get(job_id), pid,
+                                priority))
+        if started:
+            d = self.writer.run(self._record_start, started)
+            d.addCallbacks(self._started, self._start_failed,
+                           callbackArgs=(started,), errbackArgs=(started,))
+            d.addErrback(log.err)
+
+    def _record_start(self, db, started):
+        """Record that jobs were started and return the ids of those that
+        were still waiting."""
+        c = db.cursor()
+        recorded = set()
+        for job_id, user_id, pid, priority in started:
+            c.execute("""UPDATE job
+                         SET status='running', start_time=datetime('now'),
+                             pid=?
+                         WHERE job_id=? AND status='waiting'""",
+                      (pid, job_id))
+            if c.rowcount:
+                recorded.add(job_id)
+        return recorded
+
+    def _started(self, recorded, started):
+        """Called once the start of jobs is recorded. Jobs that were
+        cancelled while they were being started are killed again."""
+        with self.lock:
+            for job_id, user_id, pid, priority in started:
+                if job_id in recorded:
+                    self._count_transition('waiting', 'running')
+                    continue
+                job = self.running.pop(job_id, None)
+                if job is not None:
+                    self.queue.finished(job_id)
+                    job.kill()
+        for job_id, user_id, pid, priority in started:
+            if job_id in recorded:
+                self._publish(job_id, user_id, 'waiting', 'running')
+
+    def _start_failed(self, reason, started):
+        """Called if the start of jobs couldn't be recorded. They're still
+        waiting in the database, so they're killed and put back in the
+        queue, to be started again later."""
+        log.err(reason, 'Recording the start of jobs failed')
+        with self.lock:
+            for job_id, user_id, pid, priority in started:
+                job = self.running.pop(job_id, None)
+                if job is not None:
+                    self.queue.finished(job_id)
+                    job.kill()
+                # if the job has ended already, its end wasn't recorded
+                # either, since it wasn't running in the database
+                self.queue.push(job_id, user_id, priority)
+        reactor.callLater(self.WRITE_RETRY_DELAY, self.check_queue)
+
+    def prune_jobs(self, policy):
+        """Remove finished jobs according to a retention policy (see
+        'retention.RetentionPolicy') and return the number of removed jobs.
+
+        This can take a while, so it's meant to be called in a background
+        thread. The jobs are removed in batches, and the job counts are
+        updated as each batch is committed."""
+        def removed(statuses):
+            with self.lock:
+                for status in statuses:
+                    self._count_transition(status, None)
+        with self.pool.borrow() as db:
+            return len(policy.apply(db, removed))
+
+    def _count_transition(self, old, new):
+        """Update the job counts for a job going from state 'old' to 'new'.
+
+        Either of them can be None for jobs that are added or removed."""
+        if old is not None:
+            self.counts[old] = self.counts.get(old, 0) - 1
+        if new is not None:
+            self.counts[new] = self.counts.get(new, 0) + 1
+
+    def _publish(self, job_id, user_id, old, new):
+        """Publish the transition of a job from state 'old' to 'new'."""
+        if self.events is not None:
+            self.events.publish(job_id=job_id, user_id=user_id, previous=old,
+                                status=new)
+
+    def _count_in_database(self, db):
+        """Count the jobs in each state in the database."""
+        c = db.cursor()
+        c.execute("SELECT status, COUNT(job_id) FROM job GROUP BY status")
+        return dict(c.fetchall())
+
+    def _new_output(self, job_id, stream):
+        """Create an object to collect the job's output on 'stream', which is
+        either 'out' or 'err'."""
+        if self.output_dir is None:
+            return output.MemoryOutput()
+        return output.SpoolOutput(self._output_path(job_id, stream),
+                                  self.output_buffer_size,
+                                  self.output_flush_interval)
+
+    def _output_path(self, job_id, name):
+        """Get the path of the job's spool file 'name' ('out', 'err' or
+        'status'), or None if output isn't spooled."""
+        if self.output_dir is None:
+            return None
+        return os.path.join(self.output_dir, '%d.%s' % (job_id, name))
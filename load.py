@@ -0,0 +1,72 @@
+"""Adapting the number of jobs run on the server to the system load."""
+
+import multiprocessing
+import os
+
+
+def cpu_count():
+    """Get the number of CPUs, or 1 if it can't be determined."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def load_average():
+    """Get the load average of the last minute per CPU, or None if it isn't
+    available."""
+    try:
+        return os.getloadavg()[0] / cpu_count()
+    except (AttributeError, OSError):
+        return None
+
+
+def available_memory(meminfo='/proc/meminfo'):
+    """Get the memory available for new processes in bytes, or None if it
+    isn't available."""
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class LoadMonitor:
+
+    """Decides how many jobs may run on the server, based on the load
+    average and available memory.
+
+    The limit is raised by one job while the load average per CPU is below
+    'load_low', the available memory is above twice 'min_memory' (in bytes)
+    and all allowed jobs are running, up to 'ceiling' jobs (the number of
+    CPUs if it's None). It's lowered by one job, but not below one, while
+    the load average per CPU is above 'load_high' or the available memory is
+    below 'min_memory'. In between, it's left alone, so it doesn't go up and
+    down with every small change in load.
+    """
+
+    def __init__(self, ceiling=None, load_high=1.0, load_low=0.7,
+                 min_memory=256*1024*1024):
+        if load_low > load_high:
+            raise ValueError('load_low must not be greater than load_high')
+        self.ceiling = ceiling if ceiling is not None else cpu_count()
+        self.load_high = load_high
+        self.load_low = load_low
+        self.min_memory = min_memory
+
+    def limit(self, current, running):
+        """Get the new limit, given the 'current' limit and the number of
+        jobs that are 'running'."""
+        load = load_average()
+        memory = available_memory()
+        if (load is not None and load > self.load_high) or \
+           (memory is not None and memory < self.min_memory):
+            return max(1, min(current, self.ceiling) - 1)
+        if (load is None or load < self.load_low) and \
+           (memory is None or memory > 2 * self.min_memory) and \
+           running >= current:
+            return min(current + 1, self.ceiling)
+        return min(current, self.ceiling)
@@ -0,0 +1,72 @@
+"""Long polling for the output of running jobs.
+
+A GET request for /api/jobs/<job_id>/out or /api/jobs/<job_id>/err with the
+query parameter 'wait' waits until the job has written output beyond
+'offset', or has ended, for up to 'wait' seconds. The waiting is done by
+OutputPoll on the reactor thread, so waiting clients don't tie up request
+threads; once there is something to send, or the time is up, the request is
+passed on to the Flask app, which sends the output as usual.
+"""
+
+import re
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from events import session_user
+
+
+class OutputPoll(Resource):
+
+    """Resource that waits for the output of a running job before passing
+    the request on to the WSGI resource 'wsgi'.
+
+    Clients have to be logged in to the Flask app 'app'. Requests are passed
+    on right away if they're invalid, since the app then sends the error.
+    Clients wait for at most 'max_wait' seconds."""
+
+    isLeaf = True
+
+    PATH = re.compile(r'^/api/jobs/(\d+)/(out|err)$')
+
+    def __init__(self, app, wsgi, job_manager, max_wait=30):
+        Resource.__init__(self)
+        self.app = app
+        self.wsgi = wsgi
+        self.job_manager = job_manager
+        self.max_wait = max_wait
+
+    def handles(self, request):
+        """Check if 'request' is a request for output that may wait."""
+        return ('wait' in request.args and request.method == 'GET' and
+                self.PATH.match(request.path) is not None)
+
+    def render_GET(self, request):
+        job_id, stream = self.PATH.match(request.path).groups()
+        try:
+            offset = int(request.args.get('offset', ['0'])[0])
+            wait = min(float(request.args['wait'][0]), self.max_wait)
+        except ValueError:
+            return self.wsgi.render(request)
+        o = self.job_manager.get_output(int(job_id), stream)
+        if (o is None or offset < 0 or not wait > 0 or
+                session_user(self.app, request) is None):
+            return self.wsgi.render(request)
+
+        d = o.wait(offset)
+        if d.called:
+            return self.wsgi.render(request)
+        timeout = reactor.callLater(wait, d.cancel)
+        finished = []
+        def respond(result):
+            if timeout.active():
+                timeout.cancel()
+            if not finished:
+                self.wsgi.render(request)
+        d.addBoth(respond)
+        def disconnected(reason):
+            finished.append(True)
+            d.cancel()
+        request.notifyFinish().addErrback(disconnected)
+        return NOT_DONE_YET
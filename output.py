@@ -0,0 +1,238 @@
+"""Classes to collect the output of running scripts.
+
+Output objects have a 'write' method that is called with each chunk of data
+the script writes, a 'close' method that is called when the script has ended,
+a 'size' attribute with the number of bytes received so far and a 'path'
+attribute which is the name of the spool file or None if the output is kept
+in memory.
+
+Output is written on the reactor thread, but it can be read from other threads
+while the script is running using the 'read' method. On the reactor thread,
+'wait' returns a Deferred that fires when more output has arrived.
+"""
+
+import bz2
+import io
+import os
+import threading
+import zlib
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+
+# compression methods for output stored in the database:
+# name -> (compress(data, level), decompress(data))
+COMPRESSION = {'zlib': (zlib.compress, zlib.decompress),
+               'bz2': (bz2.compress, bz2.decompress)}
+
+
+class Output:
+
+    """Base class for output objects."""
+
+    def __init__(self):
+        self.size = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.waiters = []
+
+    def wait(self, offset):
+        """Return a Deferred that fires when there is output beyond byte
+        'offset' or the output is closed. Cancelling it stops waiting."""
+        d = defer.Deferred(lambda d: self.waiters.remove((offset, d)))
+        self.waiters.append((offset, d))
+        self.notify()
+        return d
+
+    def notify(self):
+        """Fire the Deferreds of waiters whose output has arrived."""
+        ready = [(offset, d) for offset, d in self.waiters
+                 if self.size > offset or self.closed]
+        for waiter in ready:
+            self.waiters.remove(waiter)
+            waiter[1].callback(None)
+
+    def close(self):
+        self.closed = True
+        self.notify()
+
+
+class MemoryOutput(Output):
+
+    """Collects output in memory.
+
+    Chunks are appended to a buffer instead of being concatenated to a string,
+    so collecting the output takes time linear in its size.
+    """
+
+    path = None
+
+    def __init__(self):
+        Output.__init__(self)
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        with self.lock:
+            self.buffer.write(data)
+            self.size += len(data)
+        self.notify()
+
+    def read(self, offset, size=None):
+        """Return up to 'size' bytes of output starting at byte 'offset'."""
+        with self.lock:
+            self.buffer.seek(offset)
+            data = self.buffer.read(-1 if size is None else size)
+            self.buffer.seek(0, os.SEEK_END)
+            return data
+
+    def getvalue(self):
+        """Return all output received so far."""
+        with self.lock:
+            return self.buffer.getvalue()
+
+
+class SpoolOutput(Output):
+
+    """Appends output to a spool file.
+
+    Data is collected in a small in-memory buffer, which is written to the
+    file when it grows beyond 'buffer_size' bytes or 'flush_interval' seconds
+    after the oldest unwritten chunk arrived, whichever happens first.
+    """
+
+    def __init__(self, path, buffer_size, flush_interval):
+        Output.__init__(self)
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.file = open(path, 'wb')
+        self.chunks = []
+        self.buffered = 0
+        self.delayed_flush = None
+
+    def write(self, data):
+        with self.lock:
+            self.chunks.append(data)
+            self.buffered += len(data)
+            self.size += len(data)
+        self.notify()
+        if self.buffered >= self.buffer_size:
+            self.flush()
+        elif self.delayed_flush is None:
+            self.delayed_flush = reactor.callLater(self.flush_interval,
+                                                   self.flush)
+
+    def flush(self):
+        """Write buffered data to the spool file."""
+        if self.delayed_flush is not None:
+            if self.delayed_flush.active():
+                self.delayed_flush.cancel()
+            self.delayed_flush = None
+        if self.chunks:
+            data = ''.join(self.chunks)
+            self.file.write(data)
+            self.file.flush()
+            with self.lock:
+                self.chunks = []
+                self.buffered = 0
+
+    def read(self, offset, size=None):
+        """Return up to 'size' bytes of output starting at byte 'offset'.
+
+        Output that has already been written to the spool file is read from
+        there, the rest is taken from the buffer."""
+        with self.lock:
+            end = self.size if size is None else min(self.size, offset + size)
+            written = self.size - self.buffered
+            buffered = ''.join(self.chunks)[max(offset - written, 0):
+                                             max(end - written, 0)]
+        data = ''
+        if offset < written:
+            data = read_spool(self.path, offset, min(end, written) - offset)
+        return data + buffered
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        Output.close(self)
+
+
+class FileOutput(Output):
+
+    """Output that a script writes to a file directly, e.g. because it runs
+    detached from the server (see 'process.spawn').
+
+    The output doesn't pass through the server, so 'size' is updated from
+    the file when waiting for output and when the output is closed. Unless
+    'truncate' is false, the file is created or emptied first."""
+
+    # interval for checking the file size while waiting for output
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, path, truncate=True):
+        Output.__init__(self)
+        self.path = path
+        self.poll = None
+        if truncate:
+            open(path, 'wb').close()
+        self.update()
+
+    def update(self):
+        """Update 'size' from the file."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        with self.lock:
+            self.size = size
+
+    def wait(self, offset):
+        self.update()
+        d = Output.wait(self, offset)
+        if self.waiters and self.poll is None:
+            self.poll = LoopingCall(self.check)
+            self.poll.start(self.POLL_INTERVAL, now=False)
+        return d
+
+    def check(self):
+        """Update 'size' and notify waiters, until there are none left."""
+        self.update()
+        self.notify()
+        if not self.waiters:
+            self.poll.stop()
+            self.poll = None
+
+    def write(self, data):
+        # only used for output that does pass through the server, like
+        # error messages of the supervisor
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+    def read(self, offset, size=None):
+        """Return up to 'size' bytes of output starting at byte 'offset'."""
+        return read_spool(self.path, offset, size)
+
+    def close(self):
+        self.update()
+        Output.close(self)
+
+
+def read_spool(path, offset=0, size=None):
+    """Return up to 'size' bytes of a spool file starting at byte 'offset',
+    or None if the file doesn't exist."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(-1 if size is None else size)
+
+
+def compress(data, method, level):
+    """Compress output with one of the methods in COMPRESSION."""
+    return COMPRESSION[method][0](data, level)
+
+
+def decompress(data, method):
+    """Decompress output compressed with 'compress'."""
+    return COMPRESSION[method][1](data)
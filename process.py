@@ -1,46 +1,293 @@
-from contextlib import closing
+import errno
+import json
+import os
+import signal
+import sys
 
-from flask import g
 from twisted.internet import reactor
 from twisted.internet.error import ProcessDone
 from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+
+
+SUPERVISOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'supervise.py')
+
+
+class Limits:
+
+    """Resource limits for script processes.
+
+    'memory' is the maximum address space in bytes, 'cpu' the maximum CPU
+    time and 'timeout' the maximum wall-clock time in seconds, and 'files'
+    the maximum number of open files; limits that are None don't apply. A
+    process that runs out of time is terminated, and killed if it's still
+    running 'kill_delay' seconds later. If 'accounting' is true, the resource
+    usage of processes is recorded."""
+
+    def __init__(self, memory=None, cpu=None, files=None, timeout=None,
+                 kill_delay=10, accounting=True):
+        self.memory = memory
+        self.cpu = cpu
+        self.files = files
+        self.timeout = timeout
+        self.kill_delay = kill_delay
+        self.accounting = accounting
+
+    def as_dict(self):
+        """Get the limits as a dictionary of keyword arguments."""
+        return dict(self.__dict__)
+
+    def supervised(self):
+        """Check if processes have to be run by the supervisor."""
+        return (self.accounting or self.memory is not None or
+                self.cpu is not None or self.files is not None)
+
+    def supervisor_options(self):
+        """Get the options for the supervisor (see 'supervise.py')."""
+        options = []
+        for name in ('memory', 'cpu', 'files'):
+            value = getattr(self, name)
+            if value is not None:
+                options += ['--' + name, str(int(value))]
+        return options
+
+
+def returncode(reason):
+    """Get the return code of a process from the reason it ended, made
+    negative if the process was killed by a signal (like 'subprocess')."""
+    if reason.value.signal is not None:
+        return -reason.value.signal
+    return reason.value.exitCode
+
+
+def signal_group(pid, name):
+    """Send the signal 'name' (e.g. 'TERM') to the process group of a
+    supervisor."""
+    try:
+        os.killpg(pid, getattr(signal, 'SIG' + name))
+    except OSError:
+        pass
+
+
+def is_alive(pid):
+    """Check if a process exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def is_supervisor(pid, status_path=None):
+    """Check if the process with id 'pid' is a supervisor started with the
+    status file 'status_path', or any supervisor if it's None. Where /proc
+    isn't available, this only checks that the process exists."""
+    try:
+        with open('/proc/%d/cmdline' % pid) as f:
+            return (status_path or SUPERVISOR) in f.read().split('\0')
+    except IOError as e:
+        if e.errno == errno.ENOENT and os.path.isdir('/proc/self'):
+            return False
+        return is_alive(pid)
 
 
 class RunScriptProtocol(ProcessProtocol):
 
-    """Protocol to handle a running script process."""
+    """Protocol to handle a running script process.
 
-    def __init__(self, job_id, script, callback):
+    Output on standard out and standard error is passed on to the output
+    objects 'out' and 'err' (see module 'output'). When the process has
+    ended, 'callback' is called with whether it was successful, the output
+    objects and its resource usage, which is a dictionary with its
+    'returncode' (negative if it was killed by a signal) and, if they were
+    recorded, 'max_rss', 'user_time' and 'sys_time'. The usage is None if
+    it isn't known at all."""
+
+    def __init__(self, job_id, script, out, err, callback, limits=None,
+                 detached=False):
         self.job_id = job_id
         self.script = script
+        self.out = out
+        self.err = err
         self.callback = callback
-        self.out = ''
-        self.err = ''
+        self.limits = limits or Limits(accounting=False)
+        self.detached = detached
+        self.supervised = self.limits.supervised() or detached
+        self.report = ''
+        self.timeouts = []
 
     def connectionMade(self):
         self.transport.write(self.script)
         self.transport.closeStdin()
         del self.script
+        if self.limits.timeout is not None:
+            self.timeouts.append(reactor.callLater(self.limits.timeout,
+                                                   self.time_out))
+
+    def childDataReceived(self, fd, data):
+        # the supervisor reports resource usage on file descriptor 3
+        if fd == 3:
+            self.report += data
+        else:
+            ProcessProtocol.childDataReceived(self, fd, data)
 
     def outReceived(self, data):
-        self.out += data
+        self.out.write(data)
 
     def errReceived(self, data):
-        self.err += data
+        self.err.write(data)
 
     def processEnded(self, status):
+        for call in self.timeouts:
+            if call.active():
+                call.cancel()
+        self.out.close()
+        self.err.close()
         success = status.type == ProcessDone
-        self.callback(success, self.out, self.err)
+        usage = json.loads(self.report) if self.report else {}
+        if 'returncode' not in usage:
+            usage['returncode'] = returncode(status)
+        self.callback(success, self.out, self.err, usage)
+
+    def time_out(self):
+        self.terminate()
+        self.timeouts.append(reactor.callLater(self.limits.kill_delay,
+                                               self.kill))
+
+    def send_signal(self, name):
+        if self.transport.pid is None:
+            return
+        if self.supervised:
+            # signal the supervisor's process group, so the script process
+            # gets the signal too
+            signal_group(self.transport.pid, name)
+        else:
+            self.transport.signalProcess(name)
 
     def terminate(self):
-        self.transport.signalProcess('TERM')
+        self.send_signal('TERM')
 
     def kill(self):
-        self.transport.signalProcess('KILL')
+        self.send_signal('KILL')
+
+
+def spawn(job_id, cmd, args, script, path, out, err, callback, limits=None,
+          status_path=None):
+    """Spawn a new script process and return a RunScriptProtocol object.
 
+    'limits' is a Limits object, or None for no limits.
 
-def spawn(job_id, cmd, args, script, path, callback):
-    """Spawn a new script process and return a RunScriptProtocol object."""
-    protocol = RunScriptProtocol(job_id, script, callback)
-    reactor.spawnProcess(protocol, cmd, [cmd] + args, path=path)
+    If 'status_path' is given, the process is detached from the server: it's
+    run by the supervisor, writes its output directly to the files of 'out'
+    and 'err' (see 'output.FileOutput') and keeps running if the server
+    exits. The supervisor writes the process's exit status and resource
+    usage to 'status_path', so another server process can adopt the job (see
+    'AdoptedJob')."""
+    protocol = RunScriptProtocol(job_id, script, out, err, callback, limits,
+                                 status_path is not None)
+    argv = [cmd] + args
+    child_fds = {0: 'w', 1: 'r', 2: 'r'}
+    if protocol.supervised:
+        options = protocol.limits.supervisor_options()
+        if status_path is not None:
+            options += ['--stdout', out.path, '--stderr', err.path,
+                        '--status', status_path]
+        argv = [sys.executable, SUPERVISOR] + options + ['--'] + argv
+        child_fds[3] = 'r'
+    reactor.spawnProcess(protocol, argv[0], argv, path=path,
+                         childFDs=child_fds)
     return protocol
+
+
+class AdoptedJob:
+
+    """A detached job (see 'spawn') that was started by an earlier server
+    process and is still running, or has ended since.
+
+    This has the same interface as RunScriptProtocol. Since the supervisor
+    isn't a child of this process, its status file is checked every
+    'poll_interval' seconds to find out if the job has ended. If the
+    supervisor has disappeared without writing the status file, the job has
+    failed."""
+
+    detached = True
+
+    def __init__(self, job_id, pid, out, err, status_path, callback,
+                 poll_interval=1.0):
+        self.job_id = job_id
+        self.pid = pid
+        self.out = out
+        self.err = err
+        self.status_path = status_path
+        self.callback = callback
+        self.loop = LoopingCall(self.poll)
+        self.loop.start(poll_interval, now=False)
+
+    def poll(self):
+        # the status file is written before the supervisor exits, so check
+        # if it's alive first
+        alive = is_alive(self.pid)
+        if os.path.exists(self.status_path):
+            with open(self.status_path) as f:
+                report = json.load(f)
+            self.ended(report.get('returncode') == 0, report)
+        elif not alive:
+            self.ended(False, None)
+
+    def ended(self, success, usage):
+        self.loop.stop()
+        self.out.close()
+        self.err.close()
+        self.callback(success, self.out, self.err, usage)
+
+    def terminate(self):
+        signal_group(self.pid, 'TERM')
+
+    def kill(self):
+        signal_group(self.pid, 'KILL')
+
+
+class LocalExecutor:
+
+    """Runs jobs as processes on the server, at most 'max_running' of them at
+    a time (any number if it's None)."""
+
+    def __init__(self, cmd, args, max_running, warm=None):
+        self.cmd = cmd
+        self.args = args
+        self.max_running = max_running
+        self.warm = warm
+        self.running = 0
+
+    def has_free_slot(self):
+        """Check if another job can be started."""
+        return self.max_running is None or self.running < self.max_running
+
+    def spawn(self, job_id, script, path, out, err, callback, limits=None,
+              status_path=None):
+        """Start a job and return an object to control it. See 'spawn' for
+        'limits' and 'status_path'.
+
+        Jobs that aren't detached are run by the warm pool (see
+        'warm.WarmPool'), if there is one and it has an idle fork server."""
+        self.running += 1
+        if status_path is None and self.warm is not None and \
+           self.warm.has_idle():
+            return self.warm.run(job_id, script, path, out, err,
+                                 self._ended(callback), limits)
+        return spawn(job_id, self.cmd, self.args, script, path, out, err,
+                     self._ended(callback), limits, status_path)
+
+    def adopt(self, job_id, pid, out, err, status_path, callback):
+        """Adopt a detached job started by an earlier server process and
+        return an object to control it (see 'AdoptedJob')."""
+        self.running += 1
+        return AdoptedJob(job_id, pid, out, err, status_path,
+                          self._ended(callback))
+
+    def _ended(self, callback):
+        def ended(*args):
+            self.running -= 1
+            callback(*args)
+        return ended
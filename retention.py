@@ -0,0 +1,187 @@
+"""Retention policy for finished jobs."""
+
+import os
+import time
+
+
+# states of jobs that have ended and may be removed
+FINISHED = ('done', 'failed', 'cancelled')
+
+# tables copied to the archive database
+ARCHIVED_TABLES = ('job', 'script', 'job_dependency', 'job_attempt')
+
+# jobs removed per transaction, and seconds to wait after each one, so
+# other connections can update the database in between
+BATCH_SIZE = 500
+BATCH_PAUSE = 0.1
+
+
+class RetentionPolicy:
+
+    """Decides which finished jobs are removed from the database.
+
+    A finished job is removed if it ended more than 'max_age' days ago, if
+    its owner has more than 'max_jobs' newer finished jobs, or if the output
+    of its owner's finished jobs, counting from the newest, adds up to more
+    than 'max_bytes' bytes before reaching it. Limits that are None don't
+    apply.
+
+    If 'archive' is the name of a database file, removed jobs and their
+    scripts are copied to it and spool files are left in place; otherwise
+    they're deleted for good.
+    """
+
+    def __init__(self, max_age=None, max_jobs=None, max_bytes=None,
+                 archive=None):
+        self.max_age = max_age
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.archive = archive
+
+    def enabled(self):
+        """Check if the policy removes any jobs at all."""
+        return (self.max_age is not None or self.max_jobs is not None or
+                self.max_bytes is not None)
+
+    def apply(self, db, removed=None):
+        """Remove the jobs selected by the policy.
+
+        Returns a list with the status of each removed job. See 'remove' for
+        'removed'."""
+        return self.remove(db, self.expired_jobs(db), removed)
+
+    def expired_jobs(self, db):
+        """Get the ids of finished jobs that should be removed."""
+        expired = set()
+        c = db.cursor()
+        finished = ', '.join('?' * len(FINISHED))
+        if self.max_age is not None:
+            c.execute("""SELECT job_id FROM job
+                         WHERE status IN (%s)
+                           AND end_time < datetime('now', ?)""" % finished,
+                      FINISHED + ('-%f days' % self.max_age,))
+            expired.update(row[0] for row in c.fetchall())
+        if self.max_jobs is None and self.max_bytes is None:
+            return expired
+        c.execute("SELECT user_id FROM user")
+        for (user_id,) in c.fetchall():
+            c.execute("""SELECT job_id,
+                                coalesce(out_bytes, 0) + coalesce(err_bytes, 0)
+                         FROM job
+                         WHERE user_id = ? AND status IN (%s)
+                         ORDER BY job_id DESC""" % finished,
+                      (user_id,) + FINISHED)
+            count = 0
+            total = 0
+            for job_id, size in c:
+                count += 1
+                total += size
+                if (self.max_jobs is not None and count > self.max_jobs) or \
+                   (self.max_bytes is not None and total > self.max_bytes):
+                    expired.add(job_id)
+        return expired
+
+    def remove(self, db, job_ids, removed=None):
+        """Remove (or archive) the finished jobs with the given ids.
+
+        The jobs are removed in batches, each in its own transaction. If
+        'removed' isn't None, it's called with a list of the status of each
+        job removed by a batch once the batch is committed. Returns a list
+        with the status of each removed job."""
+        job_ids = sorted(job_ids)
+        if not job_ids:
+            return []
+        c = db.cursor()
+        if self.archive is not None:
+            c.execute("ATTACH DATABASE ? AS archive", (self.archive,))
+            columns = _prepare_archive(c)
+        statuses = []
+        try:
+            for i in range(0, len(job_ids), BATCH_SIZE):
+                batch = job_ids[i:i+BATCH_SIZE]
+                condition = 'job_id IN (%s) AND status IN (%s)' % (
+                    ', '.join('?' * len(batch)),
+                    ', '.join('?' * len(FINISHED)))
+                params = batch + list(FINISHED)
+                c.execute("""SELECT job_id, status, script_digest,
+                                    out_file, err_file
+                             FROM job WHERE """ + condition,
+                          params)
+                rows = c.fetchall()
+                spool_files = []
+                ids = [(row[0],) for row in rows]
+                digests = set(row[2] for row in rows)
+                if self.archive is not None:
+                    c.execute("""INSERT INTO archive.job (%(job)s)
+                                 SELECT %(job)s FROM main.job
+                                 WHERE """ % columns + condition,
+                              params)
+                    c.executemany("""INSERT OR IGNORE
+                                     INTO archive.script (%(script)s)
+                                     SELECT %(script)s FROM main.script
+                                     WHERE digest = ?""" % columns,
+                                  [(d,) for d in digests])
+                    c.executemany("""INSERT INTO archive.job_dependency
+                                         (%(job_dependency)s)
+                                     SELECT %(job_dependency)s
+                                     FROM main.job_dependency
+                                     WHERE job_id = ?""" % columns,
+                                  ids)
+                    c.executemany("""INSERT INTO archive.job_attempt
+                                         (%(job_attempt)s)
+                                     SELECT %(job_attempt)s
+                                     FROM main.job_attempt
+                                     WHERE job_id = ?""" % columns,
+                                  ids)
+                else:
+                    spool_files.extend(f for row in rows for f in row[3:]
+                                       if f is not None)
+                c.executemany("""DELETE FROM job_dependency
+                                 WHERE job_id = ? OR parent_id = ?""",
+                              [(i, i) for (i,) in ids])
+                c.executemany("DELETE FROM job_attempt WHERE job_id = ?", ids)
+                c.execute("DELETE FROM job WHERE " + condition, params)
+                # remove scripts that are no longer used by any job
+                c.executemany("""DELETE FROM script
+                                 WHERE digest = ? AND NOT EXISTS
+                                     (SELECT 1 FROM job
+                                      WHERE script_digest = digest)""",
+                              [(d,) for d in digests])
+                db.commit()
+                for f in spool_files:
+                    if os.path.exists(f):
+                        os.remove(f)
+                batch_statuses = [row[1] for row in rows]
+                statuses.extend(batch_statuses)
+                if removed is not None:
+                    removed(batch_statuses)
+                time.sleep(BATCH_PAUSE)
+        finally:
+            if self.archive is not None:
+                db.rollback()
+                c.execute("DETACH DATABASE archive")
+        return statuses
+
+
+def _prepare_archive(c):
+    """Create the tables of the archive database, or add any columns that
+    were added to the main database since they were created.
+
+    Returns a dictionary mapping each table to a comma-separated list of its
+    columns."""
+    columns = {}
+    for table in ARCHIVED_TABLES:
+        c.execute("""CREATE TABLE IF NOT EXISTS archive.%s AS
+                     SELECT * FROM main.%s WHERE 0""" % (table, table))
+        c.execute("PRAGMA archive.table_info(%s)" % table)
+        archived = set(row[1] for row in c.fetchall())
+        c.execute("PRAGMA main.table_info(%s)" % table)
+        names = [row[1] for row in c.fetchall()]
+        for name in names:
+            if name not in archived:
+                c.execute("ALTER TABLE archive.%s ADD COLUMN %s"
+                          % (table, name))
+        columns[table] = ', '.join(names)
+    c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS archive.script_digest
+                 ON script (digest)""")
+    return columns
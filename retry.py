@@ -0,0 +1,43 @@
+"""Retry policy for failed jobs."""
+
+
+class RetryPolicy:
+
+    """Decides whether and when failed jobs are run again.
+
+    A failed job is run up to 'max_attempts' times in total, unless the job
+    sets its own maximum. If 'retry_on' is a list of return codes, only jobs
+    that failed with one of them are retried; a negative return code means
+    that the job was killed by that signal (e.g. -9 for SIGKILL). The first
+    retry is delayed by 'delay' seconds, and every further one by 'backoff'
+    times as long as the one before, but never more than 'max_delay'
+    seconds.
+    """
+
+    def __init__(self, max_attempts=1, delay=10, backoff=2.0, max_delay=3600,
+                 retry_on=None):
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1')
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.retry_on = None if retry_on is None else set(retry_on)
+
+    def may_retry(self, attempt, max_attempts=None):
+        """Check if a job may run again after its 'attempt'th attempt,
+        counting from 1. 'max_attempts' is the job's own maximum, if it has
+        one."""
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        return attempt < max_attempts
+
+    def retry_delay(self, attempt, returncode, max_attempts=None):
+        """Get the number of seconds to wait before retrying a job that
+        failed with 'returncode' (None if it isn't known) on its 'attempt'th
+        attempt, or None if it shouldn't be retried (see 'may_retry')."""
+        if not self.may_retry(attempt, max_attempts):
+            return None
+        if self.retry_on is not None and returncode not in self.retry_on:
+            return None
+        return min(self.delay * self.backoff ** (attempt - 1), self.max_delay)
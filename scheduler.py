@@ -0,0 +1,120 @@
+"""Queue of waiting jobs and policies for choosing the next job to start."""
+
+import heapq
+
+
+POLICIES = ['fifo', 'fair']
+
+
+class JobQueue:
+
+    """Queue of waiting jobs.
+
+    Each user has their own queue of jobs, ordered by priority (highest
+    first) and then by job id. The policy determines which job is started
+    next:
+
+    'fifo': the job with the highest priority is started first, regardless
+    of who submitted it; jobs with equal priority are started in the order
+    they were submitted.
+
+    'fair': the next job is taken from the queue of the user with the fewest
+    running jobs; ties are broken by round robin, i.e., the user who had a job
+    started least recently goes first. Priorities only order the jobs within
+    each user's queue, so users can't get ahead of others by raising them.
+
+    With either policy, no more than 'max_running_per_user' jobs of the same
+    user are running at a time, unless it's None.
+
+    The queue also keeps track of the jobs it started until 'finished' is
+    called for them.
+    """
+
+    def __init__(self, policy='fifo', max_running_per_user=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown scheduling policy: %s' % policy)
+        self.policy = policy
+        self.max_running_per_user = max_running_per_user
+        self.queues = {}         # user_id -> heap of (-priority, job_id)
+        self.waiting = {}        # job_id -> user_id, for jobs in the queue
+        self.running = {}        # job_id -> user_id, for started jobs
+        self.running_count = {}  # user_id -> number of started jobs
+        self.last_started = {}   # user_id -> value of 'self.starts'
+        self.starts = 0
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def __contains__(self, job_id):
+        return job_id in self.waiting
+
+    def push(self, job_id, user_id, priority=0):
+        """Add a job to the queue."""
+        heapq.heappush(self.queues.setdefault(user_id, []),
+                       (-priority, job_id))
+        self.waiting[job_id] = user_id
+
+    def pop(self):
+        """Remove the next job to start from the queue and return its id.
+
+        Returns None if no job can be started."""
+        user_id = self._next_user()
+        if user_id is None:
+            return None
+        priority, job_id = heapq.heappop(self.queues[user_id])
+        if not self.queues[user_id]:
+            del self.queues[user_id]
+        del self.waiting[job_id]
+        self.add_running(job_id, user_id)
+        self.starts += 1
+        self.last_started[user_id] = self.starts
+        return job_id
+
+    def remove(self, job_ids):
+        """Remove jobs from the queue. Ids of jobs that aren't in the queue
+        are ignored."""
+        users = set()
+        for job_id in job_ids:
+            user_id = self.waiting.pop(job_id, None)
+            if user_id is not None:
+                users.add(user_id)
+        for user_id in users:
+            queue = [entry for entry in self.queues[user_id]
+                     if entry[1] in self.waiting]
+            if queue:
+                heapq.heapify(queue)
+                self.queues[user_id] = queue
+            else:
+                del self.queues[user_id]
+
+    def add_running(self, job_id, user_id):
+        """Record that a job is running that wasn't started by 'pop', e.g.
+        one that was adopted after a restart."""
+        self.running[job_id] = user_id
+        self.running_count[user_id] = self.running_count.get(user_id, 0) + 1
+
+    def finished(self, job_id):
+        """Record that a job started by 'pop' is no longer running."""
+        user_id = self.running.pop(job_id)
+        self.running_count[user_id] -= 1
+        if not self.running_count[user_id]:
+            del self.running_count[user_id]
+
+    def _next_user(self):
+        """Get the user whose job should be started next, or None."""
+        candidates = [user_id for user_id in self.queues
+                      if self._may_start(user_id)]
+        if not candidates:
+            return None
+        if self.policy == 'fifo':
+            return min(candidates, key=lambda u: self.queues[u][0])
+        return min(candidates,
+                   key=lambda u: (self.running_count.get(u, 0),
+                                  self.last_started.get(u, 0),
+                                  self.queues[u][0][1]))
+
+    def _may_start(self, user_id):
+        """Check if another job of the user may be started."""
+        return (self.max_running_per_user is None or
+                self.running_count.get(user_id, 0) <
+                self.max_running_per_user)
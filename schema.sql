@@ -6,18 +6,77 @@ create table user (
 	admin boolean not null default 0,
 	directory text not null);
 
+drop table if exists script;
+create table script (
+	digest text primary key,
+	content blob not null);
+
 drop table if exists job;
 create table job (
 	job_id integer primary key,
 	user_id not null references user(user_id),
 	status text not null default 'waiting',
-	script blob not null,
+	priority integer not null default 0,
+	script_digest text not null references script(digest),
+	submit_time timestamp,
 	start_time timestamp,
 	end_time timestamp,
 	out text,
-	err text);
+	err text,
+	out_file text,
+	err_file text,
+	out_bytes integer,
+	err_bytes integer,
+	compression text,
+	max_rss integer,
+	user_time real,
+	sys_time real,
+	pid integer,
+	max_attempts integer,
+	retry_time timestamp);
+create index job_status on job (status, job_id);
+create index job_user on job (user_id, job_id);
+create index job_script on job (script_digest);
+
+drop table if exists job_dependency;
+create table job_dependency (
+	job_id integer not null references job(job_id),
+	parent_id integer not null references job(job_id),
+	primary key (job_id, parent_id));
+create index job_dependency_parent on job_dependency (parent_id);
+
+drop table if exists job_attempt;
+create table job_attempt (
+	job_id integer not null references job(job_id),
+	attempt integer not null,
+	start_time timestamp,
+	end_time timestamp,
+	returncode integer,
+	max_rss integer,
+	user_time real,
+	sys_time real,
+	primary key (job_id, attempt));
 
 drop table if exists clipboard;
 create table clipboard (
     user_id integer not null references user(user_id),
     file text not null);
+
+drop table if exists upload;
+create table upload (
+	upload_id text primary key,
+	user_id integer not null references user(user_id),
+	path text not null,
+	temp_path text not null,
+	size integer,
+	update_time timestamp);
+
+drop table if exists upload_chunk;
+create table upload_chunk (
+	upload_id text not null references upload(upload_id),
+	start integer not null,
+	stop integer not null,
+	primary key (upload_id, start));
+
+-- schema version, see database.py
+pragma user_version = 11;
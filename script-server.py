@@ -2,20 +2,32 @@
 
 """Script server. Run setup.py first to create database and config file."""
 
+from contextlib import closing
 import datetime
 import logging
 import os
 
 from flask import Flask, g
 from flask.ext.bcrypt import Bcrypt
-from twisted.internet import reactor
+from twisted.internet import endpoints, reactor, threads
+from twisted.internet.task import LoopingCall
+from twisted.python import log
 from twisted.web.wsgi import WSGIResource
 from twisted.python.log import PythonLoggingObserver
 from twisted.web.server import Site
 
 import api
 import database
+import events
 import jobs
+import load
+import longpoll
+import process
+import retention
+import retry
+import uploads
+import warm
+import workers
 from ui import ui
 
 version = '0.1.0'
@@ -23,12 +35,58 @@ version = '0.1.0'
 # default settings
 NAME = 'localhost'
 DATABASE = 'script-server.db'
+DATABASE_POOL = True
+DATABASE_WAL = True
+DATABASE_SYNCHRONOUS = 'NORMAL'
+DATABASE_BUSY_TIMEOUT = 5000
+DATABASE_CACHE_SIZE = -16000
 LOGFILE = 'script-server.log'
 SECRET_KEY = os.urandom(24)
 PORT = 5000
 COMMAND = '/usr/bin/python'
 ARGS = []
 MAX_RUNNING = 1
+MAX_RUNNING_PER_USER = None
+AUTO_MAX_RUNNING = None
+AUTO_LOAD_HIGH = 1.0
+AUTO_LOAD_LOW = 0.7
+AUTO_MIN_MEMORY = 256 * 1024 * 1024
+AUTO_INTERVAL = 10
+JOB_MEMORY_LIMIT = None
+JOB_CPU_LIMIT = None
+JOB_FILE_LIMIT = None
+JOB_TIMEOUT = None
+JOB_KILL_DELAY = 10
+JOB_ACCOUNTING = False
+WARM_POOL_SIZE = 0
+WARM_MAX_JOBS = 100
+WARM_PRELOAD = []
+SHUTDOWN_TIMEOUT = 0
+RECOVERY = 'fail'
+RETRY_MAX_ATTEMPTS = 1
+RETRY_DELAY = 10
+RETRY_BACKOFF = 2.0
+RETRY_MAX_DELAY = 3600
+RETRY_ON = None
+WORKER_ENDPOINT = None
+WORKER_SECRET = None
+SCHEDULING = 'fifo'
+JOBS_PAGE_SIZE = 1000
+EVENTS_KEEP_ALIVE = 15
+BATCH_MAX_JOBS = 10000
+OUTPUT_DIR = None
+OUTPUT_BUFFER_SIZE = 64 * 1024
+OUTPUT_FLUSH_INTERVAL = 1.0
+OUTPUT_MAX_WAIT = 30
+OUTPUT_COMPRESSION = None
+OUTPUT_COMPRESSION_LEVEL = 6
+RETENTION_MAX_AGE = None
+RETENTION_MAX_JOBS = None
+RETENTION_MAX_BYTES = None
+RETENTION_ARCHIVE = None
+RETENTION_INTERVAL = 3600
+LISTING_CACHE_TTL = 0
+UPLOAD_EXPIRY = 24 * 3600
 
 # create Flask app
 app = Flask(__name__)
@@ -38,29 +96,135 @@ app.config.from_pyfile('script-server.cfg', silent=True)
 api.add_api(app)
 app.register_blueprint(ui)
 
+# upgrade the database if it was created by an older version
+with closing(database.connect(app.config['DATABASE'])) as db:
+    database.migrate(db)
+
+# set up database connection pool
+pool = database.ConnectionPool(
+    app.config['DATABASE'],
+    reuse=app.config['DATABASE_POOL'],
+    wal=app.config['DATABASE_WAL'],
+    synchronous=app.config['DATABASE_SYNCHRONOUS'],
+    busy_timeout=app.config['DATABASE_BUSY_TIMEOUT'],
+    cache_size=app.config['DATABASE_CACHE_SIZE'])
+
+# accept connections from remote workers
+worker_pool = None
+if app.config['WORKER_ENDPOINT'] is not None:
+    worker_pool = workers.WorkerPool(app.config['WORKER_SECRET'])
+    endpoint = endpoints.serverFromString(reactor,
+                                          app.config['WORKER_ENDPOINT'])
+    endpoint.listen(worker_pool)
+
+# resource limits for jobs
+limits = process.Limits(app.config['JOB_MEMORY_LIMIT'],
+                        app.config['JOB_CPU_LIMIT'],
+                        app.config['JOB_FILE_LIMIT'],
+                        app.config['JOB_TIMEOUT'],
+                        app.config['JOB_KILL_DELAY'],
+                        app.config['JOB_ACCOUNTING'])
+
+# retries of failed jobs
+retry_policy = retry.RetryPolicy(app.config['RETRY_MAX_ATTEMPTS'],
+                                 app.config['RETRY_DELAY'],
+                                 app.config['RETRY_BACKOFF'],
+                                 app.config['RETRY_MAX_DELAY'],
+                                 app.config['RETRY_ON'])
+
+# fork servers for short scripts
+warm_pool = None
+if app.config['WARM_POOL_SIZE']:
+    warm_pool = warm.WarmPool(app.config['COMMAND'],
+                              app.config['ARGS'],
+                              app.config['WARM_POOL_SIZE'],
+                              app.config['WARM_MAX_JOBS'],
+                              app.config['WARM_PRELOAD'])
+
+# with MAX_RUNNING = 'auto', start with one job and adapt to the load
+max_running = app.config['MAX_RUNNING']
+load_monitor = None
+if max_running == 'auto':
+    load_monitor = load.LoadMonitor(app.config['AUTO_MAX_RUNNING'],
+                                    app.config['AUTO_LOAD_HIGH'],
+                                    app.config['AUTO_LOAD_LOW'],
+                                    app.config['AUTO_MIN_MEMORY'])
+    max_running = 1
+
+# job state changes are pushed to clients through the event broker
+event_broker = events.EventBroker()
+
 # set up JobManager object
 job_manager = jobs.JobManager(app.config['COMMAND'],
                               app.config['ARGS'],
-                              app.config['DATABASE'],
-                              app.config['MAX_RUNNING'])
+                              pool,
+                              max_running,
+                              app.config['OUTPUT_DIR'],
+                              app.config['OUTPUT_BUFFER_SIZE'],
+                              app.config['OUTPUT_FLUSH_INTERVAL'],
+                              app.config['SCHEDULING'],
+                              app.config['MAX_RUNNING_PER_USER'],
+                              app.config['OUTPUT_COMPRESSION'],
+                              app.config['OUTPUT_COMPRESSION_LEVEL'],
+                              worker_pool,
+                              limits,
+                              event_broker,
+                              app.config['RECOVERY'],
+                              retry_policy,
+                              warm_pool)
+
+# let running jobs finish when the server is stopped
+reactor.addSystemEventTrigger('before', 'shutdown', job_manager.shutdown,
+                              app.config['SHUTDOWN_TIMEOUT'])
+
+if load_monitor is not None:
+    LoopingCall(job_manager.adjust_max_running, load_monitor).start(
+        app.config['AUTO_INTERVAL'])
+
+# remove old jobs in the background
+retention_policy = retention.RetentionPolicy(
+    app.config['RETENTION_MAX_AGE'],
+    app.config['RETENTION_MAX_JOBS'],
+    app.config['RETENTION_MAX_BYTES'],
+    app.config['RETENTION_ARCHIVE'])
+if retention_policy.enabled():
+    def prune_jobs():
+        d = threads.deferToThread(job_manager.prune_jobs, retention_policy)
+        d.addErrback(log.err)
+        return d
+    LoopingCall(prune_jobs).start(app.config['RETENTION_INTERVAL'])
+
+
+# remove abandoned uploads in the background
+def expire_uploads():
+    def expire():
+        db = pool.connection()
+        try:
+            uploads.expire_uploads(db, app.config['UPLOAD_EXPIRY'])
+        finally:
+            pool.release(db)
+    d = threads.deferToThread(expire)
+    d.addErrback(log.err)
+    return d
+LoopingCall(expire_uploads).start(3600)
 
 
-# before each request: set up 'g', open database connection
+# before each request: set up 'g', get database connection
 @app.before_request
 def before_request():
     g.config = app.config
     g.version = version
     g.job_manager = job_manager
-    g.db = database.connect(app.config['DATABASE'])
+    g.db = pool.connection()
     g.bcrypt = bcrypt
 
 
-# after each request: close database connection
+# after each request: release database connection
 @app.teardown_request
 def teardown_request(exception):
     db = g.get('db')
     if db is not None:
-        db.close()
+        pool.release(db)
 
 
 @app.template_filter('format_datetime')
@@ -101,6 +265,10 @@ observer.start()
 
 # start Twisted server
 resource = WSGIResource(reactor, reactor.getThreadPool(), app)
-site = Site(resource)
+event_stream = events.EventStream(app, event_broker, pool,
+                                  app.config['EVENTS_KEEP_ALIVE'])
+output_poll = longpoll.OutputPoll(app, resource, job_manager,
+                                  app.config['OUTPUT_MAX_WAIT'])
+site = Site(events.SiteRoot(resource, event_stream, output_poll))
 reactor.listenTCP(app.config['PORT'], site)
 reactor.run()
@@ -0,0 +1,34 @@
+"""Content-addressed storage for scripts.
+
+Each distinct script is stored once in the script table, keyed by the SHA-256
+digest of its content. Jobs only reference scripts by their digest, so
+submitting the same script many times doesn't grow the database.
+"""
+
+import hashlib
+
+
+def digest(content):
+    """Get the digest of a script."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def store(c, content):
+    """Store a script using the cursor 'c' and return its digest.
+
+    Nothing is written if the script is stored already. Scripts given as
+    unicode, like those submitted with the web form, are stored as UTF-8."""
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    d = digest(content)
+    c.execute("INSERT OR IGNORE INTO script (digest, content) VALUES (?, ?)",
+              (d, buffer(content)))
+    return d
+
+
+def load(c, d):
+    """Get the script with digest 'd' using the cursor 'c', or None if there
+    is no such script."""
+    c.execute("SELECT content FROM script WHERE digest=?", (d,))
+    row = c.fetchone()
+    return None if row is None else str(row[0])
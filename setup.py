@@ -19,7 +19,13 @@ logfile = raw_input('Log file: [script-server.log] ') or 'script-server.log'
 if os.path.exists(dbfile):
     y = raw_input('Database file %s exists already. Overwrite? ' % dbfile)
     if not y.startswith('y'):
-        exit(1)
+        y = raw_input('Upgrade it to the current schema instead? ')
+        if not y.startswith('y'):
+            exit(1)
+        with closing(database.connect(dbfile)) as db:
+            database.migrate(db)
+        print('Database is at schema version %d.' % database.SCHEMA_VERSION)
+        exit(0)
 if os.path.exists('script-server.cfg'):
     y = raw_input('Configuration file server.cfg exists already. Overwrite? ')
     if not y.startswith('y'):
@@ -0,0 +1,11 @@
+$(function() {
+    // update the status of listed jobs when it changes
+    if (!window.EventSource) {
+        return;
+    }
+    var events = new EventSource($("#jobs").data("events"));
+    events.addEventListener("job", function(e) {
+        var job = JSON.parse(e.data);
+        $("#jobs tr[data-job-id=" + job.job_id + "] .status").text(job.status);
+    });
+});
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""Run a script interpreter with resource limits and report its resource
+usage.
+
+This is started by the server (see 'process.spawn') instead of the
+interpreter itself when resource limits or accounting are enabled:
+
+    python supervise.py [--memory BYTES] [--cpu SECONDS] [--files N]
+                        [--stdout FILE --stderr FILE --status FILE] -- CMD ...
+
+The interpreter inherits standard in, and standard out and error unless
+'--stdout' and '--stderr' name files to append its output to. When it has
+ended, its exit status ('returncode', negative for a signal) and resource
+usage are written as a JSON object to file descriptor 3 and, with '--status',
+to a file. The supervisor then exits with the interpreter's exit status, or is
+killed by the same signal. The supervisor starts a new session, so the server
+can signal both processes at once and they keep running if the server exits;
+it ignores SIGTERM itself, so it can still report on an interpreter that was
+terminated.
+"""
+
+import argparse
+import errno
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+
+
+def set_limits(options):
+    """Set resource limits; called in the interpreter process before exec."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    limits = [(resource.RLIMIT_AS, options.memory),
+              (resource.RLIMIT_CPU, options.cpu),
+              (resource.RLIMIT_NOFILE, options.files)]
+    for limit, value in limits:
+        if value is not None:
+            resource.setrlimit(limit, (value, value))
+
+
+def wait(pid):
+    """Wait for a process to end and return its status and resource usage."""
+    while True:
+        try:
+            _, status, usage = os.wait4(pid, 0)
+            return status, usage
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+def write_report(report, path=None):
+    """Write the report to file descriptor 3, if the server is still
+    listening, and to the file 'path', if it's given."""
+    try:
+        with os.fdopen(3, 'w') as f:
+            json.dump(report, f)
+    except (IOError, OSError):
+        pass
+    if path is not None:
+        # write to a temporary file first, so the status file is complete
+        # once it exists
+        with open(path + '.tmp', 'w') as f:
+            json.dump(report, f)
+        os.rename(path + '.tmp', path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a script interpreter '
+                                                 'with resource limits.')
+    parser.add_argument('--memory', type=int,
+                        help='maximum address space in bytes')
+    parser.add_argument('--cpu', type=int, help='maximum CPU time in seconds')
+    parser.add_argument('--files', type=int,
+                        help='maximum number of open files')
+    parser.add_argument('--stdout', help='file to append standard out to')
+    parser.add_argument('--stderr', help='file to append standard error to')
+    parser.add_argument('--status',
+                        help='file to write the exit status and resource '
+                             'usage to')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    options = parser.parse_args()
+    command = options.command
+    if command and command[0] == '--':
+        command = command[1:]
+
+    os.setsid()
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    stdout = stderr = None
+    if options.stdout is not None:
+        stdout = open(options.stdout, 'ab')
+    if options.stderr is not None:
+        stderr = open(options.stderr, 'ab')
+    child = subprocess.Popen(command, stdout=stdout, stderr=stderr,
+                             close_fds=True,
+                             preexec_fn=lambda: set_limits(options))
+    status, usage = wait(child.pid)
+
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    write_report({'returncode': returncode,
+                  'max_rss': usage.ru_maxrss,
+                  'user_time': usage.ru_utime,
+                  'sys_time': usage.ru_stime},
+                 options.status)
+
+    if os.WIFSIGNALED(status):
+        sig = os.WTERMSIG(status)
+        signal.signal(sig, signal.SIG_DFL)
+        os.kill(os.getpid(), sig)
+    sys.exit(os.WEXITSTATUS(status))
+
+
+if __name__ == '__main__':
+    main()
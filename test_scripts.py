@@ -0,0 +1,57 @@
+"""Tests for the script storage.
+
+Run with 'python -m unittest test_scripts'.
+"""
+
+from contextlib import closing
+import unittest
+
+from flask import Flask, request
+
+import database
+import scripts
+
+
+def submitted_scripts(text):
+    """Get a script the way the web form and the API receive it."""
+    app = Flask(__name__)
+    with app.test_request_context('/script', method='POST',
+                                  data={'script': text}):
+        form_script = request.form['script']
+    with app.test_request_context('/api/run', method='POST',
+                                  data=text.encode('utf-8'),
+                                  content_type='text/plain'):
+        api_script = request.data
+    return form_script, api_script
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = database.connect(':memory:')
+        with open('schema.sql') as f:
+            self.db.executescript(f.read())
+
+    def tearDown(self):
+        self.db.close()
+
+    def check_same_script(self, text):
+        form_script, api_script = submitted_scripts(text)
+        with closing(self.db.cursor()) as c:
+            form_digest = scripts.store(c, form_script)
+            api_digest = scripts.store(c, api_script)
+            self.assertEqual(form_digest, api_digest)
+            self.assertEqual(scripts.load(c, form_digest),
+                             text.encode('utf-8'))
+            self.assertEqual(scripts.digest(scripts.load(c, api_digest)),
+                             api_digest)
+
+    def test_ascii_script(self):
+        self.check_same_script(u'print("hello")\n')
+
+    def test_non_ascii_script(self):
+        self.check_same_script(u'print("gr\xfc\xdfe \u263a")\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,14 @@
 """Web-based user interface for script server."""
 
 from flask import abort, Blueprint, flash, g, render_template, redirect
-from flask import request, send_file, session, url_for
+from flask import request, session, url_for
 from werkzeug import secure_filename
 
 from sessions import admin_required, login_required
+import downloads
 import files
 import sessions
+import uploads
 import users
 
 ui = Blueprint('User Interface', __name__)
@@ -22,12 +24,16 @@ def info():
     if 'user_id' in session:
         sessions.load_user_info()
     title = 'Server %s' % g.config.get('NAME')
-    running = g.job_manager.count_jobs(g.db, 'running')
-    waiting = g.job_manager.count_jobs(g.db, 'waiting')
+    count = lambda status: g.job_manager.count_jobs(g.db, status)
     return render_template('info.html', title=title,
                            version=g.version,
-                           jobs_running=running,
-                           jobs_waiting=waiting)
+                           jobs_running=count('running'),
+                           jobs_waiting=count('waiting'),
+                           jobs_blocked=count('blocked'),
+                           jobs_retrying=count('retrying'),
+                           jobs_done=count('done'),
+                           jobs_failed=count('failed'),
+                           jobs_cancelled=count('cancelled'))
 
 
 @ui.route('/login', methods=['GET', 'POST'])
@@ -56,9 +62,15 @@ def logout():
 def jobs():
     g.title = 'Jobs'
     highlight = request.args.get('highlight', None)
-    jobs = g.job_manager.list_jobs(g.db)
+    after_id = request.args.get('after_id', None, type=int)
+    status = request.args.get('status', None)
+    limit = 100
+    jobs = g.job_manager.list_jobs(g.db, after_id, limit, status=status)
+    total = g.job_manager.count_matching_jobs(g.db, status=status)
+    next_id = jobs[-1]['job_id'] if len(jobs) == limit else None
     return render_template('jobs.html',
-                           title='Jobs', jobs=jobs, highlight=highlight)
+                           title='Jobs', jobs=jobs, highlight=highlight,
+                           total=total, status=status, next_id=next_id)
 
 
 def signal_job(job_id, action):
@@ -100,7 +112,8 @@ def job_details(job_id):
 def script():
     if request.method == 'POST':
         script = request.form['script']
-        job_id = g.job_manager.new_job(g.db, g.user_id, script)
+        priority = request.form.get('priority', 0, type=int)
+        job_id = g.job_manager.new_job(g.db, g.user_id, script, priority)
         return redirect(url_for('.jobs', highlight=job_id))
     return render_template('script.html', title='Script')
 
@@ -119,7 +132,7 @@ def file_ui(p):
         abort(404)
     if files.is_directory(path):
         return file_listing(p)
-    return send_file(files.absolute(path))
+    return downloads.send_file(files.absolute(path))
 
 
 def file_listing(p, error=None):
@@ -136,7 +149,7 @@ def file_listing(p, error=None):
             info['link_path'] = '%s/%s' % (p, f['name'])
         info['size'] = f['size'] if 'size' in f else None
         return info
-    listing = [format_info(f) for f in files.directory_listing(path)]
+    listing = [format_info(f) for f in files.directory_listing(path)[0]]
 
     # get clipboard info
     clipboard_files = users.get_clipboard(g.user_id)
@@ -210,7 +223,7 @@ def upload():
     f = request.files['file']
     if f:
         filename = secure_filename(f.filename)
-        f.save(files.absolute('/%s/%s' % (p, filename)))
+        uploads.write_file(files.absolute('/%s/%s' % (p, filename)), f.stream)
     return redirect(url_for('.file_ui', p=p))
 
 
@@ -0,0 +1,185 @@
+"""Resumable uploads.
+
+A large file can be uploaded in chunks, in any order and in parallel, to a
+hidden temporary file in the directory it's uploaded to. The server records
+which parts of the file it has received, so after a failure, the client can
+ask for them and send only what's missing. When all of it has arrived, the
+upload is committed: the file's checksum is verified, if the client gave
+one, and the temporary file is renamed to the file's name, so the file
+appears complete or not at all.
+"""
+
+import hashlib
+import os
+
+
+# checksum algorithms clients may use to verify uploads
+CHECKSUMS = ('md5', 'sha1', 'sha256')
+
+BLOCK_SIZE = 256 * 1024
+
+
+class UploadError(Exception):
+
+    """Exception raised if an upload can't be committed."""
+
+
+def temporary_path(path, name=None):
+    """Get the path of a hidden temporary file in the same directory as
+    'path', which can be renamed to 'path' atomically."""
+    if name is None:
+        name = os.urandom(8).encode('hex')
+    return os.path.join(os.path.dirname(path), '.upload-%s' % name)
+
+
+def write_file(path, stream):
+    """Write a file from a stream, replacing it atomically once all of it
+    has been written."""
+    temp_path = temporary_path(path)
+    try:
+        with open(temp_path, 'wb') as f:
+            copy(stream, f)
+        os.rename(temp_path, path)
+    except:
+        remove(temp_path)
+        raise
+
+
+def copy(stream, f):
+    """Copy a stream to a file and return the number of bytes copied."""
+    n = 0
+    while True:
+        data = stream.read(BLOCK_SIZE)
+        if not data:
+            return n
+        f.write(data)
+        n += len(data)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def merge(ranges):
+    """Merge sorted (start, stop) tuples into a list of disjoint ranges."""
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def new_upload(db, user_id, r_path, path, size=None):
+    """Start uploading a file to 'r_path' in the user's directory, which is
+    'path' as an absolute path, optionally with its size in bytes, and return
+    the upload id."""
+    upload_id = os.urandom(16).encode('hex')
+    temp_path = temporary_path(path, upload_id)
+    open(temp_path, 'wb').close()
+    c = db.cursor()
+    c.execute("""INSERT INTO upload (upload_id, user_id, path, temp_path,
+                                     size, update_time)
+                 VALUES (?, ?, ?, ?, ?, datetime('now'))""",
+              (upload_id, user_id, r_path, temp_path, size))
+    db.commit()
+    return upload_id
+
+
+def get_upload(db, upload_id, user_id):
+    """Get an upload of the user as a dictionary with its 'upload_id', the
+    'path' in the user's directory, the absolute 'temp_path', the 'size' and
+    the ranges 'received' so far, as a list of [start, stop] pairs, or None
+    if there's no such upload."""
+    c = db.cursor()
+    c.execute("""SELECT path, temp_path, size FROM upload
+                 WHERE upload_id=? AND user_id=?""",
+              (upload_id, user_id))
+    row = c.fetchone()
+    if row is None:
+        return None
+    c.execute("""SELECT start, stop FROM upload_chunk
+                 WHERE upload_id=? ORDER BY start""",
+              (upload_id,))
+    received = [list(r) for r in merge(c.fetchall())]
+    return {'upload_id': upload_id, 'path': row[0], 'temp_path': row[1],
+            'size': row[2], 'received': received}
+
+
+def write_chunk(db, upload, offset, stream):
+    """Write a chunk of an upload, starting at 'offset', from a stream, and
+    record it as received once all of it has been written. Return the number
+    of bytes written."""
+    with open(upload['temp_path'], 'r+b') as f:
+        f.seek(offset)
+        n = copy(stream, f)
+    c = db.cursor()
+    c.execute("""INSERT OR REPLACE INTO upload_chunk (upload_id, start, stop)
+                 VALUES (?, ?, ?)""",
+              (upload['upload_id'], offset, offset + n))
+    c.execute("""UPDATE upload SET update_time=datetime('now')
+                 WHERE upload_id=?""",
+              (upload['upload_id'],))
+    db.commit()
+    return n
+
+
+def commit_upload(db, upload, path, checksums):
+    """Finish an upload and move the file into place at the absolute path
+    'path'.
+
+    'checksums' maps algorithms from CHECKSUMS to the expected hex digest of
+    the file. Raises UploadError if parts of the file are missing or a
+    checksum doesn't match; the upload can then be continued.
+    """
+    received = upload['received']
+    size = upload['size']
+    if size is None:
+        size = received[-1][1] if received else 0
+    if size and received != [[0, size]]:
+        raise UploadError('Upload incomplete, received: %s' % received)
+    hashes = dict((name, hashlib.new(name)) for name in checksums)
+    with open(upload['temp_path'], 'r+b') as f:
+        # in case a chunk was sent again, shorter than the first time
+        f.truncate(size)
+        while hashes:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            for h in hashes.values():
+                h.update(data)
+        os.fsync(f.fileno())
+    for name, h in hashes.items():
+        if h.hexdigest() != checksums[name].lower():
+            raise UploadError('Checksum mismatch (%s)' % name)
+    os.rename(upload['temp_path'], path)
+    delete_records(db, upload['upload_id'])
+
+
+def delete_upload(db, upload):
+    """Cancel an upload and remove what was received."""
+    remove(upload['temp_path'])
+    delete_records(db, upload['upload_id'])
+
+
+def delete_records(db, upload_id):
+    c = db.cursor()
+    c.execute('DELETE FROM upload_chunk WHERE upload_id=?', (upload_id,))
+    c.execute('DELETE FROM upload WHERE upload_id=?', (upload_id,))
+    db.commit()
+
+
+def expire_uploads(db, max_age):
+    """Cancel uploads that haven't received anything for 'max_age'
+    seconds."""
+    c = db.cursor()
+    c.execute("""SELECT upload_id, temp_path FROM upload
+                 WHERE update_time < datetime('now', ?)""",
+              ('-%d seconds' % max_age,))
+    for upload_id, temp_path in c.fetchall():
+        remove(temp_path)
+        delete_records(db, upload_id)
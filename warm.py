@@ -0,0 +1,221 @@
+"""A pool of warm interpreter processes for short scripts.
+
+Starting a new interpreter for every script takes longer than running most
+short scripts. A WarmPool keeps a number of fork servers running instead
+(see 'forkserver.py'): Python interpreters that have already started, and
+possibly imported some modules, and run one script at a time in a forked
+child process. The script's output is passed on to the job's output objects
+up to the end marker the fork server writes after it.
+"""
+
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+
+import process
+
+
+FORKSERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'forkserver.py')
+
+
+class WarmJob:
+
+    """A script run by a fork server. This has the same interface as
+    'process.RunScriptProtocol'."""
+
+    detached = False
+
+    def __init__(self, job_id, out, err, callback, limits=None):
+        self.job_id = job_id
+        self.out = out
+        self.err = err
+        self.callback = callback
+        self.limits = limits or process.Limits(accounting=False)
+        self.marker = '\0%s\0' % os.urandom(8).encode('hex')
+        self.pid = None
+        self.usage = None
+        # streams whose end marker hasn't arrived yet
+        self.streams = set([1, 2])
+        self.timeouts = []
+
+    def request(self, script, path):
+        """Get the request for the fork server to run the script."""
+        request = {'token': self.marker.strip('\0'), 'directory': path,
+                   'size': len(script), 'memory': self.limits.memory,
+                   'cpu': self.limits.cpu, 'files': self.limits.files}
+        if self.limits.timeout is not None:
+            self.timeouts.append(reactor.callLater(self.limits.timeout,
+                                                   self.time_out))
+        return json.dumps(request) + '\n' + script
+
+    def ended(self, usage):
+        """Called when the script has ended, with its exit status and
+        resource usage, or None if the fork server was lost."""
+        for call in self.timeouts:
+            if call.active():
+                call.cancel()
+        self.out.close()
+        self.err.close()
+        if usage is not None and not self.limits.accounting:
+            usage = {'returncode': usage['returncode']}
+        success = usage is not None and usage['returncode'] == 0
+        self.callback(success, self.out, self.err, usage)
+
+    def time_out(self):
+        self.terminate()
+        self.timeouts.append(reactor.callLater(self.limits.kill_delay,
+                                               self.kill))
+
+    def send_signal(self, name):
+        # the script runs in its own session, see 'forkserver.py'
+        if self.pid is not None:
+            process.signal_group(self.pid, name)
+
+    def terminate(self):
+        self.send_signal('TERM')
+
+    def kill(self):
+        self.send_signal('KILL')
+
+
+class ForkServerProtocol(ProcessProtocol):
+
+    """Protocol to handle a fork server process, which runs one job at a
+    time."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.job = None
+        self.jobs_run = 0
+        self.reports = ''
+        self.pending = {1: '', 2: ''}
+
+    def run(self, job, script, path):
+        self.job = job
+        self.jobs_run += 1
+        self.transport.write(job.request(script, path))
+
+    def childDataReceived(self, fd, data):
+        if fd == 3:
+            self.reports += data
+            while '\n' in self.reports:
+                line, self.reports = self.reports.split('\n', 1)
+                self.report_received(json.loads(line))
+        elif self.job is not None and fd in self.job.streams:
+            self.output_received(fd, data)
+        elif fd == 2:
+            # e.g. errors while preloading modules
+            log.msg('Fork server: %s' % data.rstrip())
+
+    def output_received(self, fd, data):
+        job = self.job
+        o = job.out if fd == 1 else job.err
+        data = self.pending[fd] + data
+        end = data.find(job.marker)
+        if end >= 0:
+            o.write(data[:end])
+            self.pending[fd] = ''
+            job.streams.discard(fd)
+            self.check_ended()
+            return
+        # hold back what may be the beginning of the marker
+        keep = data.rfind('\0', max(len(data) - len(job.marker) + 1, 0))
+        if keep < 0:
+            keep = len(data)
+        if keep:
+            o.write(data[:keep])
+        self.pending[fd] = data[keep:]
+
+    def report_received(self, report):
+        if self.job is None:
+            return
+        if 'pid' in report:
+            self.job.pid = report['pid']
+        else:
+            self.job.usage = report
+            self.check_ended()
+
+    def check_ended(self):
+        """End the job once its exit status and all of its output have
+        arrived."""
+        job = self.job
+        if job.usage is None or job.streams:
+            return
+        self.job = None
+        job.ended(job.usage)
+        self.pool.released(self)
+
+    def processEnded(self, status):
+        job = self.job
+        if job is not None:
+            self.job = None
+            for fd, o in ((1, job.out), (2, job.err)):
+                if self.pending[fd]:
+                    o.write(self.pending[fd])
+            job.ended(None)
+        self.pool.lost(self, status)
+
+
+class WarmPool:
+
+    """Keeps 'size' fork servers running, started with the Python
+    interpreter 'cmd' and its arguments 'args', after importing the modules
+    in 'preload'. Each fork server is replaced after it has run 'max_jobs'
+    scripts, or when it exits; if it failed, it's restarted after
+    'restart_delay' seconds."""
+
+    def __init__(self, cmd, args, size, max_jobs=100, preload=(),
+                 restart_delay=5):
+        self.cmd = cmd
+        self.args = args
+        self.max_jobs = max_jobs
+        self.preload = preload
+        self.restart_delay = restart_delay
+        self.idle = []
+        for i in range(size):
+            self._start()
+
+    def has_idle(self):
+        """Check if a fork server is ready to run a script."""
+        return bool(self.idle)
+
+    def run(self, job_id, script, path, out, err, callback, limits=None):
+        """Run a script on an idle fork server and return a WarmJob object to
+        control it. 'limits' is a 'process.Limits' object, or None for no
+        limits."""
+        server = self.idle.pop()
+        job = WarmJob(job_id, out, err, callback, limits)
+        server.run(job, script, path)
+        return job
+
+    def released(self, server):
+        """Called when a fork server has finished a job."""
+        if server.jobs_run >= self.max_jobs:
+            # the fork server exits when standard in is closed
+            server.transport.closeStdin()
+        else:
+            self.idle.append(server)
+
+    def lost(self, server, status):
+        """Called when a fork server has exited."""
+        if server in self.idle:
+            self.idle.remove(server)
+        if server.jobs_run >= self.max_jobs:
+            self._start()
+        else:
+            log.msg('Fork server exited unexpectedly: %s' % status.value)
+            reactor.callLater(self.restart_delay, self._start)
+
+    def _start(self):
+        protocol = ForkServerProtocol(self)
+        argv = [self.cmd] + self.args + [FORKSERVER]
+        if self.preload:
+            argv += ['--preload', ','.join(self.preload)]
+        reactor.spawnProcess(protocol, argv[0], argv,
+                             childFDs={0: 'w', 1: 'r', 2: 'r', 3: 'r'})
+        # requests wait in the pipe until the fork server is ready
+        self.idle.append(protocol)
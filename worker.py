@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""Worker for script server. Connects to a server, runs the jobs it's sent
+and streams their output back.
+
+Example:
+
+    python worker.py tcp:host=myserver:port=5001 --capacity 4 \\
+                     --command /usr/bin/python
+
+The server has to be configured to accept workers with 'WORKER_ENDPOINT'. The
+users' directories must be available under the same paths as on the server.
+"""
+
+import argparse
+import os
+import socket
+import sys
+
+from twisted.application.internet import ClientService
+from twisted.internet import reactor
+from twisted.internet.endpoints import clientFromString
+from twisted.internet.protocol import Factory
+from twisted.python import log
+
+import process
+import workers
+
+
+class ForwardingOutput:
+
+    """Output object (see module 'output') that sends output to the server."""
+
+    path = None
+
+    def __init__(self, connection, job_id, stream):
+        self.connection = connection
+        self.job_id = job_id
+        self.stream = stream
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.connection.send(type='output', job_id=self.job_id,
+                             stream=self.stream, data=workers.encode(data))
+
+    def close(self):
+        pass
+
+
+class ServerConnection(workers.MessageProtocol):
+
+    """Worker side of the connection to the server."""
+
+    def connectionMade(self):
+        self.jobs = {}
+        options = self.factory.options
+        self.send(type='register', name=options.name,
+                  capacity=options.capacity, secret=options.secret)
+
+    def connectionLost(self, reason):
+        # the server requeues the jobs, so don't let them run twice
+        for job in self.jobs.values():
+            job.kill()
+
+    def message_run(self, job_id, script, directory, limits=None):
+        options = self.factory.options
+        out = ForwardingOutput(self, job_id, 'out')
+        err = ForwardingOutput(self, job_id, 'err')
+        if limits is not None:
+            limits = process.Limits(**limits)
+        def callback(success, out, err, usage):
+            del self.jobs[job_id]
+            self.send(type='finished', job_id=job_id, success=success,
+                      usage=usage)
+        self.jobs[job_id] = process.spawn(job_id, options.command,
+                                          options.args, workers.decode(script),
+                                          directory, out, err, callback,
+                                          limits)
+
+    def message_signal(self, job_id, signal):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        if signal == 'TERM':
+            job.terminate()
+        elif signal == 'KILL':
+            job.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Script server worker.')
+    parser.add_argument('server',
+                        help='server endpoint, e.g. tcp:host=myserver:'
+                             'port=5001 or unix:path=/tmp/workers.sock')
+    parser.add_argument('--capacity', type=int, default=1,
+                        help='number of jobs to run at the same time')
+    parser.add_argument('--command', default='/usr/bin/python',
+                        help='script interpreter')
+    parser.add_argument('--arg', dest='args', action='append', default=[],
+                        help='argument for the script interpreter')
+    parser.add_argument('--name', default=socket.gethostname(),
+                        help='name of the worker')
+    secret = os.environ.get('SCRIPT_SERVER_WORKER_SECRET')
+    parser.add_argument('--secret', default=secret,
+                        help='shared secret to register with the server '
+                             '(default: $SCRIPT_SERVER_WORKER_SECRET)')
+    options = parser.parse_args()
+
+    log.startLogging(sys.stdout)
+    factory = Factory.forProtocol(ServerConnection)
+    factory.options = options
+    endpoint = clientFromString(reactor, options.server)
+    ClientService(endpoint, factory).startService()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Pool of remote workers that run jobs on other hosts.
+
+Workers (see 'worker.py') connect to the server, register with the number of
+jobs they can run at the same time and then run the jobs the server sends
+them, streaming their output back. If a worker's connection is lost, the jobs
+it was running are put back in the queue.
+
+Messages are JSON objects sent as length-prefixed strings. Each message has a
+'type'; script text and output are base64-encoded. Workers send
+
+    {"type": "register", "name": ..., "capacity": ..., "secret": ...}
+    {"type": "output", "job_id": ..., "stream": "out" or "err", "data": ...}
+    {"type": "finished", "job_id": ..., "success": ..., "usage": ...}
+
+and the server sends
+
+    {"type": "run", "job_id": ..., "script": ..., "directory": ...,
+     "limits": ...}
+    {"type": "signal", "job_id": ..., "signal": "TERM" or "KILL"}
+
+where "limits" holds the arguments of 'process.Limits' (or is null) and
+"usage" is the job's resource usage (see 'process.RunScriptProtocol').
+"""
+
+import base64
+import hmac
+import json
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+
+class MessageProtocol(Int32StringReceiver):
+
+    """Protocol for exchanging messages between server and workers.
+
+    A received message of type 'foo' is passed as keyword arguments to the
+    method 'message_foo'."""
+
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def send(self, **message):
+        """Send a message. Can be called from any thread."""
+        reactor.callFromThread(self.sendString, json.dumps(message))
+
+    def stringReceived(self, string):
+        try:
+            message = json.loads(string)
+            handler = getattr(self, 'message_' + message.pop('type'))
+            handler(**dict((str(k), v) for k, v in message.items()))
+        except Exception:
+            log.err(None, 'Invalid message from %s' % self.transport.getPeer())
+            self.transport.loseConnection()
+
+
+def encode(data):
+    """Encode script text or output for a message."""
+    return base64.b64encode(data)
+
+
+def decode(data):
+    """Decode script text or output from a message."""
+    return base64.b64decode(data)
+
+
+class RemoteJob:
+
+    """A job running on a worker.
+
+    This has the same interface as 'process.RunScriptProtocol'."""
+
+    detached = False
+
+    def __init__(self, worker, job_id, out, err, callback):
+        self.worker = worker
+        self.job_id = job_id
+        self.out = out
+        self.err = err
+        self.callback = callback
+
+    def ended(self, success, usage=None):
+        self.out.close()
+        self.err.close()
+        self.callback(success, self.out, self.err, usage)
+
+    def terminate(self):
+        self.worker.send(type='signal', job_id=self.job_id, signal='TERM')
+
+    def kill(self):
+        self.worker.send(type='signal', job_id=self.job_id, signal='KILL')
+
+
+class WorkerConnection(MessageProtocol):
+
+    """Server side of the connection to a worker."""
+
+    def connectionMade(self):
+        self.name = None
+        self.capacity = 0
+        self.jobs = {}
+
+    def connectionLost(self, reason):
+        self.factory.worker_lost(self)
+
+    def free_slots(self):
+        return self.capacity - len(self.jobs)
+
+    def message_register(self, name, capacity, secret=None):
+        if not self.factory.check_secret(secret):
+            log.msg('Worker %s failed to authenticate' % name)
+            self.transport.loseConnection()
+            return
+        if (not isinstance(capacity, (int, long)) or
+                isinstance(capacity, bool) or capacity < 0):
+            raise ValueError('Invalid capacity: %r' % (capacity,))
+        self.name = name
+        self.capacity = capacity
+        self.factory.worker_registered(self)
+
+    def message_output(self, job_id, stream, data):
+        getattr(self.jobs[job_id], stream).write(decode(data))
+
+    def message_finished(self, job_id, success, usage=None):
+        self.jobs.pop(job_id).ended(success, usage)
+
+
+class WorkerPool(ServerFactory):
+
+    """Keeps track of the connected workers and dispatches jobs to them.
+
+    Workers have to send 'secret' when they register. The job manager
+    using the pool sets the callbacks 'job_lost', which is called with the
+    job id of each job that was running on a lost worker, and
+    'capacity_changed', which is called when new workers are available."""
+
+    protocol = WorkerConnection
+
+    def __init__(self, secret):
+        if secret is None:
+            raise ValueError('Workers require a secret')
+        self.secret = secret
+        self.workers = []
+        self.job_lost = None
+        self.capacity_changed = None
+
+    def check_secret(self, secret):
+        return secret is not None and \
+            hmac.compare_digest(str(secret), str(self.secret))
+
+    def has_free_slot(self):
+        """Check if another job can be started."""
+        return any(w.free_slots() > 0 for w in self.workers)
+
+    def spawn(self, job_id, script, path, out, err, callback, limits=None):
+        """Start a job on the worker with the most free slots and return an
+        object to control it. The worker enforces 'limits' (see
+        'process.Limits') if they're given."""
+        worker = max(self.workers, key=lambda w: w.free_slots())
+        job = RemoteJob(worker, job_id, out, err, callback)
+        worker.jobs[job_id] = job
+        worker.send(type='run', job_id=job_id, script=encode(script),
+                    directory=path,
+                    limits=None if limits is None else limits.as_dict())
+        return job
+
+    def worker_registered(self, worker):
+        log.msg('Worker %s registered with capacity %d'
+                % (worker.name, worker.capacity))
+        self.workers.append(worker)
+        self.capacity_changed()
+
+    def worker_lost(self, worker):
+        if worker not in self.workers:
+            return
+        log.msg('Lost worker %s, requeueing %d jobs'
+                % (worker.name, len(worker.jobs)))
+        self.workers.remove(worker)
+        for job_id, job in worker.jobs.items():
+            job.out.close()
+            job.err.close()
+            self.job_lost(job_id)
+        worker.jobs.clear()